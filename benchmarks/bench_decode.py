@@ -0,0 +1,38 @@
+import argparse
+import os
+import tempfile
+import time
+
+from reScriptable.exporter import line_reader
+from reScriptable.exporter.line_reader import RMPage
+
+from .synthetic import write_rm
+
+
+def bench(path, name, columnar, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        page = RMPage(path, name, columnar)
+        layers = page.layers
+        best = min(best, time.perf_counter() - start)
+    n_points = sum(s.n_points for l in layers for s in l.strokes)
+    page.close()
+    return n_points, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-point and columnar .rm decoding")
+    parser.add_argument('--strokes', type=int, default=500)
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'page.rm'), 'wb') as f:
+            write_rm(f, n_strokes=args.strokes, n_points=args.points)
+
+        backend = 'numpy' if line_reader.np is not None else 'array'
+        for label, columnar in [('per-point', False), (f'columnar ({backend})', True)]:
+            n_points, t = bench(tmp, 'page', columnar, args.repeat)
+            print(f"{label:20s} {n_points / t:14,.0f} points/s ({t * 1000:.1f} ms)")
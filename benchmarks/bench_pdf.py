@@ -0,0 +1,37 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from reScriptable.exporter.line_reader import RMDocument
+from reScriptable.exporter.pdf_export import RMToPDF
+
+from .synthetic import write_document
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the inkscape and native PDF backends")
+    parser.add_argument('--documents', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--strokes', type=int, default=100)
+    parser.add_argument('--points', type=int, default=100)
+    args = parser.parse_args()
+
+    backends = ['native']
+    if shutil.which('inkscape') and shutil.which('pdftk'):
+        backends.insert(0, 'inkscape')
+    else:
+        print("inkscape or pdftk not found, only benchmarking the native backend")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uuids = [f'doc{i}' for i in range(args.documents)]
+        for uuid in uuids:
+            write_document(tmp, uuid, n_pages=args.pages, n_strokes=args.strokes, n_points=args.points)
+
+        for backend in backends:
+            start = time.perf_counter()
+            for uuid in uuids:
+                RMToPDF(RMDocument(tmp, uuid)).write(os.path.join(tmp, 'out', f'{uuid}.pdf'), backend)
+            t = time.perf_counter() - start
+            print(f"{backend:10s} {len(uuids) / t:8.2f} documents/s ({t:.2f} s)")
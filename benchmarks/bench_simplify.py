@@ -0,0 +1,58 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from io import StringIO
+
+from reScriptable.exporter.line_reader import RMDocument
+from reScriptable.exporter.svg_export import RMToSVG
+
+from .synthetic import write_document
+
+
+def render_time(svg_path, tmp):
+    start = time.perf_counter()
+    subprocess.run(['inkscape', f'--export-filename={os.path.join(tmp, "out.pdf")}', svg_path],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare SVG output of the variable width modes, with and without stroke simplification")
+    parser.add_argument('--strokes', type=int, default=300)
+    parser.add_argument('--points', type=int, default=300)
+    parser.add_argument('--tolerance', type=float, default=1.)
+    parser.add_argument('--width-step', type=float, default=.5)
+    args = parser.parse_args()
+
+    has_inkscape = shutil.which('inkscape') is not None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_document(tmp, 'doc', n_strokes=args.strokes, n_points=args.points)
+        doc = RMDocument(tmp, 'doc')
+
+        configs = [
+            ('segments', None),
+            ('runs', args.tolerance),
+            ('outline', None),
+            ('outline', args.tolerance),
+        ]
+        for mode, tolerance in configs:
+            label = mode if tolerance is None else f'{mode} ({tolerance}px)'
+            to_svg = RMToSVG(doc, simplify=tolerance, width_step=args.width_step, variable_width=mode)
+            output = StringIO()
+            start = time.perf_counter()
+            to_svg.write([output])
+            t = time.perf_counter() - start
+            svg = output.getvalue()
+
+            result = f"{label:22s} {svg.count('<polyline') + svg.count('<path'):8d} elements {len(svg) / 1024:10.1f} KiB  svg {t * 1000:8.1f} ms"
+            if has_inkscape:
+                svg_path = os.path.join(tmp, 'page.svg')
+                with open(svg_path, 'w') as f:
+                    f.write(svg)
+                result += f"  inkscape {render_time(svg_path, tmp) * 1000:8.1f} ms"
+            print(result)
@@ -0,0 +1,47 @@
+import argparse
+import gzip
+import tempfile
+import time
+
+from io import BytesIO, StringIO
+
+from reScriptable.exporter.line_reader import RMDocument
+from reScriptable.exporter.svg_export import RMToSVG
+
+from .synthetic import write_document
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure SVG emission speed for text, binary and gzip outputs")
+    parser.add_argument('--strokes', type=int, default=300)
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--variable-width', default='segments', choices=['outline', 'runs', 'segments'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_document(tmp, 'doc', n_strokes=args.strokes, n_points=args.points)
+        to_svg = RMToSVG(RMDocument(tmp, 'doc'), variable_width=args.variable_width)
+
+        outputs = [
+            ('text', StringIO, lambda s: len(s.getvalue().encode())),
+            ('binary', BytesIO, lambda s: len(s.getvalue())),
+        ]
+        for label, make_output, size in outputs:
+            best = float('inf')
+            for _ in range(args.repeat):
+                output = make_output()
+                start = time.perf_counter()
+                to_svg.write([output])
+                best = min(best, time.perf_counter() - start)
+            n_bytes = size(output)
+            print(f"{label:8s} {n_bytes / best / 1e6:8.2f} MB/s ({n_bytes / 1024:.0f} KiB in {best * 1000:.1f} ms)")
+
+        best = float('inf')
+        for _ in range(args.repeat):
+            raw = BytesIO()
+            start = time.perf_counter()
+            with gzip.GzipFile(fileobj=raw, mode='wb') as output:
+                to_svg.write([output])
+            best = min(best, time.perf_counter() - start)
+        print(f"{'gzip':8s} {len(raw.getvalue()) / best / 1e6:8.2f} MB/s ({len(raw.getvalue()) / 1024:.0f} KiB in {best * 1000:.1f} ms)")
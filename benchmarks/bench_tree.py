@@ -0,0 +1,39 @@
+import argparse
+import os
+import tempfile
+import time
+
+from reScriptable.sync.metadata_index import MetadataIndex
+from reScriptable.sync.rm_to_dir import RMDirectory
+
+from .synthetic import write_metadata_tree
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how RMDirectory scales with the number of metadata files")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as index_dir:
+            write_metadata_tree(tmp, size)
+
+            start = time.perf_counter()
+            direc = RMDirectory(tmp)
+            total = time.perf_counter() - start
+
+            start = time.perf_counter()
+            direc._build_structure()
+            tree = time.perf_counter() - start
+
+            index = MetadataIndex(os.path.join(index_dir, 'index.sqlite'))
+            start = time.perf_counter()
+            RMDirectory(tmp, index)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            RMDirectory(tmp, index)
+            warm = time.perf_counter() - start
+            index.close()
+
+            print(f"{size:8d} files: load {total * 1000:9.1f} ms, of which tree {tree * 1000:8.1f} ms; "
+                  f"with index: cold {cold * 1000:9.1f} ms, warm {warm * 1000:9.1f} ms")
@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from io import StringIO
+
+from reScriptable.exporter import line_reader
+from reScriptable.exporter.decoded_cache import DecodedPageCache
+from reScriptable.exporter.line_reader import RMDocument, RMPage
+from reScriptable.exporter.svg_export import RMToSVG
+from reScriptable.sync.rm_to_dir import RMDirectory
+
+from .synthetic import ALL_PEN_TYPES, write_document, write_library, write_metadata_tree, write_rm
+
+SYNC_RM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sync_rm')
+
+# Seconds sync_rm may take on top of starting the interpreter, for a run with nothing to export
+STARTUP_BUDGET = 0.2
+
+# Problem sizes per scale. 'small' runs in a few seconds and is meant for quick checks.
+SCALES = {
+    'small': dict(strokes=100, points=100, tree_files=1000, library_files=20, pages=2),
+    'default': dict(strokes=500, points=200, tree_files=10000, library_files=100, pages=3),
+    'large': dict(strokes=2000, points=200, tree_files=100000, library_files=500, pages=5),
+}
+
+
+def best_of(repeat, fn):
+    """
+    Run fn repeat times and return the shortest time in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_decode(tmp, size, repeat):
+    with open(os.path.join(tmp, 'page.rm'), 'wb') as f:
+        write_rm(f, n_strokes=size['strokes'], n_points=size['points'], pen_types=ALL_PEN_TYPES)
+    n_points = size['strokes'] * size['points']
+
+    def stream():
+        with RMPage(tmp, 'page') as page:
+            for _ in page.iter_strokes():
+                pass
+
+    def layers(columnar):
+        with RMPage(tmp, 'page', columnar) as page:
+            page.layers
+
+    cache = DecodedPageCache(os.path.join(tmp, 'decoded'))
+    cache.page(tmp, 'page').close()
+
+    def cached():
+        with cache.page(tmp, 'page') as page:
+            for _ in page.iter_strokes():
+                pass
+
+    results = {}
+    for name, fn in [('stream', stream), ('cached', cached), ('columnar', lambda: layers(True)),
+                     ('per_point', lambda: layers(False))]:
+        t = best_of(repeat, fn)
+        results[name] = {'seconds': t, 'points_per_second': n_points / t}
+    return results
+
+
+def bench_tree(tmp, size, repeat):
+    write_metadata_tree(tmp, size['tree_files'])
+    t = best_of(repeat, lambda: RMDirectory(tmp))
+    return {'load': {'seconds': t, 'files_per_second': size['tree_files'] / t}}
+
+
+def bench_svg(tmp, size, repeat):
+    write_document(tmp, 'doc', n_strokes=size['strokes'], n_points=size['points'])
+    doc = RMDocument(tmp, 'doc')
+    results = {}
+    for mode in ('outline', 'runs', 'segments'):
+        to_svg = RMToSVG(doc, variable_width=mode)
+        output = StringIO()
+
+        def write():
+            output.seek(0)
+            output.truncate()
+            to_svg.write([output])
+
+        t = best_of(repeat, write)
+        results[mode] = {'seconds': t, 'bytes': len(output.getvalue())}
+    return results
+
+
+def bench_to_readable(tmp, size, repeat):
+    rm_path = os.path.join(tmp, 'xochitl')
+    documents = write_library(rm_path, size['library_files'], size['pages'],
+                              n_strokes=size['strokes'] // 5, n_points=size['points'])
+    direc = RMDirectory(rm_path)
+    out_dir = os.path.join(tmp, 'nice')
+
+    def full():
+        direc.to_readable(out_dir, only_update=False, backend='native')
+
+    def unchanged():
+        direc.to_readable(out_dir, backend='native')
+
+    return {
+        'full': {'seconds': best_of(repeat, full), 'documents': len(documents)},
+        'unchanged': {'seconds': best_of(repeat, unchanged)},
+    }
+
+
+def bench_startup(tmp, size, repeat):
+    local_raw = os.path.join(tmp, 'raw')
+    snapshot = os.path.join(local_raw, '2024-01-01 00:00:00')
+    write_library(os.path.join(snapshot, 'xochitl'), size['library_files'] // 5, 1,
+                  n_strokes=size['strokes'] // 5, n_points=size['points'])
+    os.symlink(snapshot, os.path.join(local_raw, 'latest'))
+    command = [sys.executable, SYNC_RM, '-c', os.path.join(tmp, 'missing.json'), '--no-sync', '--backend', 'native',
+               '-l', local_raw, '-L', os.path.join(tmp, 'nice')]
+    # The first run exports everything, the timed ones find nothing changed
+    subprocess.run(command, check=True, capture_output=True)
+
+    interpreter = best_of(repeat, lambda: subprocess.run([sys.executable, '-c', 'pass'], check=True))
+    unchanged = best_of(repeat, lambda: subprocess.run(command, check=True, capture_output=True))
+    overhead = unchanged - interpreter
+    if overhead > STARTUP_BUDGET:
+        print(f"Warning: sync_rm took {overhead * 1000:.1f} ms on top of the interpreter, "
+              f"over the budget of {STARTUP_BUDGET * 1000:.0f} ms", file=sys.stderr)
+    return {
+        'interpreter': {'seconds': interpreter},
+        'unchanged': {'seconds': unchanged, 'overhead': overhead, 'budget': STARTUP_BUDGET},
+    }
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'tree': bench_tree,
+    'svg': bench_svg,
+    'to_readable': bench_to_readable,
+    'startup': bench_startup,
+}
+
+
+def git_revision():
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return res.stdout.strip() or None
+
+
+def compare(old, new):
+    """
+    Print the change in every timing between two result files.
+    """
+    for bench, cases in new['results'].items():
+        for case, values in cases.items():
+            try:
+                before = old['results'][bench][case]['seconds']
+            except KeyError:
+                continue
+            after = values['seconds']
+            print(f"{bench + '.' + case:24s} {before * 1000:10.1f} ms -> {after * 1000:10.1f} ms ({after / before:6.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on synthetic data and record the results")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f"Benchmarks to run, any of {', '.join(BENCHMARKS)}. Defaults to all")
+    parser.add_argument('--scale', choices=list(SCALES), default='default')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help="Write the results as JSON, defaults to benchmarks/results/<revision>.json")
+    parser.add_argument('--compare', help="Earlier result file to compare against")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark: '{name}'")
+
+    size = SCALES[args.scale]
+    revision = git_revision()
+    report = {
+        'revision': revision,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': line_reader.np is not None,
+        'scale': args.scale,
+        'size': size,
+        'results': {},
+    }
+
+    for name in args.benchmarks or BENCHMARKS:
+        with tempfile.TemporaryDirectory() as tmp:
+            report['results'][name] = BENCHMARKS[name](tmp, size, args.repeat)
+        for case, values in report['results'][name].items():
+            print(f"{name + '.' + case:24s} {values['seconds'] * 1000:10.1f} ms", file=sys.stderr)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                              f"{revision or 'unknown'}-{args.scale}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w+') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
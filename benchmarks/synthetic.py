@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import random
+import struct
+
+from typing import BinaryIO, Optional, Sequence
+
+from reScriptable.exporter.svg_export import RMPen
+
+RM_HEADER = b'reMarkable .lines file, version=5'.ljust(43)
+
+# Every pen type RMPen knows about, and the ones it actually draws
+ALL_PEN_TYPES = tuple(RMPen.PEN_TYPES)
+DEFAULT_PEN_TYPES = (4, 5, 12, 15, 17, 18, 21)
+
+
+def write_rm(f: BinaryIO, n_layers: int = 1, n_strokes: int = 100, n_points: int = 200,
+             pen_types: Sequence[int] = DEFAULT_PEN_TYPES, seed: Optional[int] = 0):
+    """
+    Write a synthetic v5 .rm page to f.
+
+    Every stroke is a wobbly line of n_points points somewhere on a 1404x1872 page.
+    """
+    rng = random.Random(seed)
+    f.write(RM_HEADER)
+    f.write(struct.pack('<i', n_layers))
+    for _ in range(n_layers):
+        f.write(struct.pack('<i', n_strokes))
+        for _ in range(n_strokes):
+            pen = rng.choice(pen_types)
+            base_size = rng.choice((1.875, 2.0, 2.125))
+            f.write(struct.pack('<iiiffi', pen, rng.randrange(3), 0, base_size, 0., n_points))
+
+            x, y = rng.uniform(0, 1404), rng.uniform(0, 1872)
+            direction = rng.uniform(0, 2 * math.pi)
+            width = 2.
+            points = bytearray()
+            for _ in range(n_points):
+                direction += rng.uniform(-.3, .3)
+                speed = rng.uniform(0, 50)
+                width = min(max(width + rng.uniform(-.2, .2), 1.), 6.)
+                x = min(max(x + math.cos(direction) * 2, 0), 1404)
+                y = min(max(y + math.sin(direction) * 2, 0), 1872)
+                points += struct.pack('<ffffff', x, y, speed, direction, width, rng.random())
+            f.write(points)
+
+
+def write_document(root: str, uuid: str, name: str = 'Document', n_pages: int = 1, parent: str = '',
+                   last_modified: str = '1', seed: Optional[int] = 0, **rm_args):
+    """
+    Write a notebook in xochitl layout (metadata, content, pagedata and one .rm file per page) to root.
+    rm_args are passed on to write_rm.
+    """
+    with open(os.path.join(root, f'{uuid}.metadata'), 'w') as f:
+        json.dump({'visibleName': name, 'type': 'DocumentType', 'lastModified': last_modified, 'parent': parent}, f)
+    write_content(root, uuid, n_pages, seed, **rm_args)
+
+
+def write_folder(root: str, uuid: str, name: str = 'Folder', parent: str = '', last_modified: str = '1'):
+    """
+    Write the .metadata file of a folder to root.
+    """
+    with open(os.path.join(root, f'{uuid}.metadata'), 'w') as f:
+        json.dump({'visibleName': name, 'type': 'CollectionType', 'lastModified': last_modified, 'parent': parent}, f)
+
+
+def write_content(root: str, uuid: str, n_pages: int = 1, seed: Optional[int] = 0, **rm_args):
+    """
+    Write everything of a notebook except its .metadata file to root.
+    """
+    pages = [f'{uuid}-page-{i}' for i in range(n_pages)]
+    with open(os.path.join(root, f'{uuid}.content'), 'w') as f:
+        json.dump({'pages': pages, 'pageCount': n_pages}, f)
+    with open(os.path.join(root, f'{uuid}.pagedata'), 'w') as f:
+        f.write('Blank\n' * n_pages)
+
+    os.makedirs(os.path.join(root, uuid), exist_ok=True)
+    for i, page in enumerate(pages):
+        with open(os.path.join(root, uuid, f'{page}.rm'), 'wb') as f:
+            write_rm(f, seed=None if seed is None else seed + i, **rm_args)
+
+
+def write_metadata_tree(root: str, n_files: int, fanout: int = 10, folder_ratio: float = .1,
+                        trash_ratio: float = .05, seed: Optional[int] = 0):
+    """
+    Write only the .metadata files of a synthetic xochitl library to root.
+
+    Folders are nested by attaching every new file to a random earlier folder, with at most
+    fanout folders on the top level. A fraction of the files is placed in the trash.
+
+    Returns:
+        The uuids of all files written.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    folders = []
+    uuids = []
+    for i in range(n_files):
+        uuid = f'{i:08x}-0000-4000-8000-{rng.getrandbits(48):012x}'
+        is_folder = i < fanout or rng.random() < folder_ratio
+        if i < fanout or not folders:
+            parent = ''
+        elif rng.random() < trash_ratio:
+            parent = 'trash'
+        else:
+            parent = rng.choice(folders)
+
+        with open(os.path.join(root, f'{uuid}.metadata'), 'w') as f:
+            json.dump({
+                'visibleName': f'{"Folder" if is_folder else "Notebook"} {i}',
+                'type': 'CollectionType' if is_folder else 'DocumentType',
+                'lastModified': str(1600000000000 + i),
+                'parent': parent,
+            }, f)
+
+        if is_folder:
+            folders.append(uuid)
+        uuids.append(uuid)
+    return uuids
+
+
+def write_library(root: str, n_files: int, n_pages: int = 2, fanout: int = 10, folder_ratio: float = .1,
+                  trash_ratio: float = .05, seed: Optional[int] = 0, **rm_args):
+    """
+    Write a complete synthetic xochitl library to root: a tree as written by write_metadata_tree,
+    with n_pages pages of strokes for every document. rm_args are passed on to write_rm.
+
+    Returns:
+        The uuids of all documents written.
+    """
+    documents = []
+    for i, uuid in enumerate(write_metadata_tree(root, n_files, fanout, folder_ratio, trash_ratio, seed)):
+        with open(os.path.join(root, f'{uuid}.metadata')) as f:
+            if json.load(f)['type'] != 'DocumentType':
+                continue
+        write_content(root, uuid, n_pages, None if seed is None else seed + i * n_pages, **rm_args)
+        documents.append(uuid)
+    return documents
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write a synthetic xochitl library, e.g. as input for sync_rm --no-sync")
+    parser.add_argument('root', help="Directory to write the .metadata, .content, .pagedata and .rm files to")
+    parser.add_argument('--files', type=int, default=100, help="Number of folders and documents")
+    parser.add_argument('--pages', type=int, default=2)
+    parser.add_argument('--layers', type=int, default=1)
+    parser.add_argument('--strokes', type=int, default=100)
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--all-pens', action='store_true',
+                        help="Use every pen type in RMPen.PEN_TYPES, including the ones that are not drawn")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    documents = write_library(args.root, args.files, args.pages, seed=args.seed, n_layers=args.layers,
+                              n_strokes=args.strokes, n_points=args.points,
+                              pen_types=ALL_PEN_TYPES if args.all_pens else DEFAULT_PEN_TYPES)
+    print(f"Wrote {args.files} files, of which {len(documents)} documents, to {args.root}")
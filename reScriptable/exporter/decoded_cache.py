@@ -0,0 +1,204 @@
+from typing import BinaryIO, Text
+
+import mmap
+import os
+import struct
+import tempfile
+
+from .line_reader import (POINT_SIZE, STROKE_HEADER, RMLayer, RMPage, RMStroke, RMStrokeHeader,
+                          decode_points, points_bbox, read_header)
+from .page_cache import PageCache
+from .. import profiling
+
+# File layout, all little endian:
+#   FILE_HEADER
+#   STROKE_ENTRY for every stroke, in file order: the .rm stroke header, followed by the layer,
+#       the index of the first point and the bounding box of the stroke
+#   The points of all strokes as one block of float32, POINT_FIELDS per point, as in .rm files
+MAGIC = b'RMDC'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHfii')
+STROKE_ENTRY = struct.Struct('<iiiffiiI4f')
+
+
+def write_decoded(f: BinaryIO, rm_file: BinaryIO):
+    """
+    Convert the .rm file rm_file to the decoded page format, see CachedPage.
+    """
+    version, n_layers = read_header(rm_file)
+    entries = []
+    blocks = []
+    n_points_total = 0
+    for layer_idx in range(n_layers):
+        [n_strokes] = struct.unpack('<i', rm_file.read(4))
+        for _ in range(n_strokes):
+            header = STROKE_HEADER.unpack(rm_file.read(STROKE_HEADER.size))
+            raw = rm_file.read(POINT_SIZE * header[-1])
+            bbox = points_bbox(decode_points(raw))
+            entries.append(STROKE_ENTRY.pack(*header, layer_idx, n_points_total, *bbox))
+            blocks.append(raw)
+            n_points_total += header[-1]
+
+    f.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, 0, version, n_layers, len(entries)))
+    f.writelines(entries)
+    f.writelines(blocks)
+
+
+class CachedPage(RMPage):
+    """
+    A page loaded from the decoded page format instead of its .rm file.
+
+    The file is memory mapped, the stroke table is read at once, and the points of every
+    stroke are handed out as views of the mapping (with numpy) without parsing or copying.
+    """
+    def __init__(self, cache_path: os.PathLike, path: os.PathLike, pagename: Text, columnar: bool = True):
+        self.columnar = columnar
+        self.metadata = self.read_metadata(path, pagename)
+
+        with open(cache_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, _, self.version, self.n_layers, n_strokes = FILE_HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"{cache_path} is not a decoded page of format version {FORMAT_VERSION}")
+            if self.metadata and self.n_layers != len(self.metadata["layers"]):
+                raise ValueError(
+                    "Layer mismatch between metadata and .rm file!")
+
+            table_end = FILE_HEADER.size + STROKE_ENTRY.size * n_strokes
+            with memoryview(self._mm) as mv:
+                self.entries = list(STROKE_ENTRY.iter_unpack(mv[FILE_HEADER.size:table_end]))
+            self._points_offset = table_end
+        except:
+            self.close()
+            raise
+
+        self.layer_offsets = []
+        self._layers = None
+        self._index = None
+        profiling.count('pages')
+
+    @property
+    def bboxes(self):
+        """
+        Bounding box (min_x, min_y, max_x, max_y) of every stroke, in the order of iter_strokes.
+        """
+        return [entry[8:12] for entry in self.entries]
+
+    @property
+    def layers(self):
+        if self._layers is None:
+            strokes = [[] for _ in range(self.n_layers)]
+            for layer_idx, header, data in self.iter_strokes():
+                stroke = RMStroke.from_header(header, data)
+                if not self.columnar:
+                    stroke._points = list(stroke.points)
+                    stroke.data = None
+                strokes[layer_idx].append(stroke)
+            self._layers = [RMLayer.from_strokes(self.layer_name(i), s) for i, s in enumerate(strokes)]
+        return self._layers
+
+    def _iter_all(self):
+        for i in range(len(self.entries)):
+            yield self.stroke(i)
+
+    def stroke(self, idx: int):
+        if self._mm is None:
+            raise ValueError("Page is closed")
+        entry = self.entries[idx]
+        header = RMStrokeHeader._make(entry[:6])
+        start = self._points_offset + POINT_SIZE * entry[7]
+        if profiling.enabled:
+            profiling.count('strokes')
+            profiling.count('points', header.n_points)
+        with memoryview(self._mm) as mv:
+            return entry[6], header, decode_points(mv[start:start + POINT_SIZE * header.n_points])
+
+    def close(self):
+        self._layers = None
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Points handed out by iter_strokes still refer to the mapping, it is
+                # unmapped once they are gone
+                pass
+            self._mm = None
+
+
+class DecodedPageCache(PageCache):
+    """
+    Persistent cache of decoded pages, keyed by the content of their .rm files.
+
+    Hashing a page takes about as long as decoding it, so every entry is also linked from
+    by-stat/, under the device, inode, size and mtime of the .rm file it was made from.
+    Snapshots hard link unchanged files, so a page is only hashed the first time it is seen.
+
+    Entries are written atomically, so several processes can share a directory.
+    Pass an instance to RMDocument to load pages through it.
+    """
+    def __init__(self, directory: os.PathLike, max_bytes: int = 1024 * 1024 * 1024):
+        super().__init__(directory, max_bytes, suffix='.rmd')
+        self.stat_dir = os.path.join(self.directory, 'by-stat')
+        os.makedirs(self.stat_dir, exist_ok=True)
+
+    def page(self, path: os.PathLike, pagename: Text, columnar: bool = True) -> RMPage:
+        """
+        Open a page like RMPage(path, pagename, columnar), decoding it into the cache first if needed.
+        """
+        rm_path = os.path.join(path, f"{pagename}.rm")
+        st = os.stat(rm_path)
+        link = os.path.join(self.stat_dir, f"{st.st_dev}-{st.st_ino}-{st.st_size}-{st.st_mtime_ns}")
+        try:
+            key = os.path.basename(os.readlink(link))[:-len(self.suffix)]
+            cache_path = self.get(key)
+        except OSError:
+            cache_path = None
+
+        if cache_path is None:
+            profiling.count('decoded_cache_misses')
+            key = self.key(rm_path, format=FORMAT_VERSION)
+            cache_path = self.get(key) or self._build(rm_path, key)
+            self._link(link, key)
+        else:
+            profiling.count('decoded_cache_hits')
+
+        try:
+            return CachedPage(cache_path, path, pagename, columnar)
+        except FileNotFoundError:
+            # Evicted by someone else in the meantime
+            return RMPage(path, pagename, columnar)
+
+    def _build(self, rm_path: os.PathLike, key: Text) -> Text:
+        with open(rm_path, 'rb') as rm_file:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    write_decoded(f, rm_file)
+                os.replace(tmp_path, self.path(key))
+            except:
+                os.remove(tmp_path)
+                raise
+        return self.path(key)
+
+    def _link(self, link: Text, key: Text):
+        tmp_link = f"{link}.{os.getpid()}.tmp"
+        try:
+            os.symlink(os.path.join('..', key + self.suffix), tmp_link)
+            os.replace(tmp_link, link)
+        except OSError:
+            # Only a shortcut, the page is hashed again next time
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used pages until the cache is at most max_bytes, and the links to them.
+        """
+        super().evict()
+        for entry in os.scandir(self.stat_dir):
+            if not os.path.exists(entry.path):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
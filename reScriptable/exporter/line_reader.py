@@ -1,12 +1,156 @@
-from typing import BinaryIO, Iterable, Text
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Text
 
 import json
+import math
+import mmap
 import os
 import glob
 import struct
+import sys
+import time
+
+from array import array
+from collections import namedtuple
+
+from .spatial import STROKE_MARGIN, StrokeGrid, segment_distance
+from .. import profiling
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+STROKE_HEADER = struct.Struct('<iiiffi')
+POINT_FIELDS = ('x', 'y', 'speed', 'direction', 'width', 'pressure')
+POINT_SIZE = 4 * len(POINT_FIELDS)
+
+RMStrokeHeader = namedtuple('RMStrokeHeader', ['pen_type', 'color', 'unknown1', 'base_size', 'unknown2', 'n_points'])
+
+if np is not None:
+    POINT_DTYPE = np.dtype([(name, '<f4') for name in POINT_FIELDS])
+else:
+    POINT_DTYPE = None
+
+
+def decode_points(buf: bytes):
+    """
+    Decode a block of packed points.
+
+    Returns a structured numpy array with one field per entry in POINT_FIELDS,
+    or, if numpy is not available, a flat array('f') with the fields interleaved.
+    """
+    if np is not None:
+        return np.frombuffer(buf, dtype=POINT_DTYPE)
+
+    data = array('f')
+    data.frombytes(buf)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+def points_xy(data):
+    """
+    Get the x and y coordinates of points decoded by decode_points, as two sequences.
+    """
+    if np is not None:
+        return data['x'], data['y']
+    n = len(POINT_FIELDS)
+    return data[0::n], data[1::n]
+
+
+def points_bbox(data):
+    """
+    Bounding box (min_x, min_y, max_x, max_y) of points decoded by decode_points, or zeros if there are none.
+    """
+    xs, ys = points_xy(data)
+    if not len(xs):
+        return 0., 0., 0., 0.
+    if np is not None:
+        return float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def read_header(f: BinaryIO):
+    """
+    Read the file header of a .rm file.
+
+    Returns:
+        (version, n_layers)
+    """
+    title = str(f.read(43))
+    version = float(title.rsplit("=")[-1].split()[0])
+    [n_layers] = struct.unpack('<i', f.read(4))
+    return version, n_layers
+
+
+def iter_strokes(f: BinaryIO, n_layers: Optional[int] = None):
+    """
+    Walk through a .rm file in a single pass, without building layers or points.
+
+    Args:
+        f: The file. If n_layers is None, f should be positioned at the start of the file,
+            otherwise at the start of the first layer.
+        n_layers: Number of layers to read, if the header has already been read.
+
+    Yields:
+        (layer_index, RMStrokeHeader, points) for every stroke, where points is decoded as by decode_points.
+    """
+    if n_layers is None:
+        _, n_layers = read_header(f)
+    for layer_idx in range(n_layers):
+        [n_strokes] = struct.unpack('<i', f.read(4))
+        for _ in range(n_strokes):
+            if profiling.enabled:
+                start = time.perf_counter()
+            header = RMStrokeHeader._make(STROKE_HEADER.unpack(f.read(STROKE_HEADER.size)))
+            points = decode_points(f.read(POINT_SIZE * header.n_points))
+            if profiling.enabled:
+                profiling.add_time('decode', time.perf_counter() - start)
+                profiling.count('strokes')
+                profiling.count('points', header.n_points)
+            yield layer_idx, header, points
+
+
+def page_stats(f: BinaryIO):
+    """
+    Count strokes and points, and measure ink length and bounding box of a .rm file.
+    All measures are plain floats, the same with and without numpy.
+    """
+    n_strokes, n_points, ink_length = 0, 0, 0.
+    min_x = min_y = float('inf')
+    max_x = max_y = float('-inf')
+    for _, header, data in iter_strokes(f):
+        n_strokes += 1
+        n_points += header.n_points
+        if not header.n_points:
+            continue
+        x0, y0, x1, y1 = points_bbox(data)
+        min_x, min_y = min(min_x, x0), min(min_y, y0)
+        max_x, max_y = max(max_x, x1), max(max_y, y1)
+        xs, ys = points_xy(data)
+        if np is not None:
+            xs, ys = xs.tolist(), ys.tolist()
+        ink_length += sum(math.hypot(x1 - x0, y1 - y0) for x0, y0, x1, y1 in zip(xs, ys, xs[1:], ys[1:]))
+
+    return {
+        'strokes': n_strokes,
+        'points': n_points,
+        'ink_length': ink_length,
+        'bbox': (min_x, min_y, max_x, max_y) if n_points else None,
+    }
+
 
 class RMDocument:
-    def __init__(self, path: os.PathLike, name: Text):
+    def __init__(self, path: os.PathLike, name: Text, columnar: bool = True, cache=None):
+        """
+        Args:
+            path: The xochitl directory.
+            name: uuid of the document.
+            columnar: How strokes are read, see RMStroke.
+            cache: A DecodedPageCache to load pages from instead of parsing their .rm files.
+        """
         self.path = path
         self.name = name
 
@@ -26,55 +170,311 @@ class RMDocument:
         else:
             self.pdf = None
 
-        self.pages: Iterable[RMPage] = []
-        for page in self.content_data['pages']:
-            try:
-                self.pages.append(RMPage(self.content_dir, page))
-            except:
-                self.pages.append(None)
+        self.pages: Sequence[Optional[RMPage]] = RMPages(self.content_dir, self.content_data['pages'], columnar, cache)
+
+    def page_path(self, idx: int) -> Text:
+        """
+        Path of the .rm file of a page. The file does not exist for pages without strokes.
+        """
+        return os.path.join(self.content_dir, f"{self.content_data['pages'][idx]}.rm")
+
+    def template(self, idx: int) -> Optional[Text]:
+        """
+        Name of the template of a page according to .pagedata, or None for blank pages.
+        """
+        if idx >= len(self.pagedata):
+            return None
+        name = self.pagedata[idx].strip()
+        return name if name and name != 'Blank' else None
+
+    def is_annotated(self, idx: int) -> bool:
+        """
+        Whether a page has any strokes, reading no more than the stroke count of each layer.
+        Pages whose .rm file is missing or cannot be read count as not annotated.
+        """
+        try:
+            with open(self.page_path(idx), 'rb') as f:
+                _, n_layers = read_header(f)
+                for _ in range(n_layers):
+                    [n_strokes] = struct.unpack('<i', f.read(4))
+                    if n_strokes > 0:
+                        return True
+        except (OSError, ValueError, struct.error):
+            pass
+        return False
+
+
+class RMPages(Sequence):
+    """
+    Lazy sequence of the pages in a document.
+
+    A page is loaded each time it is accessed and is not kept around, so iterating
+    over the document only holds one page in memory at a time.
+    Pages that fail to load are returned as None.
+    """
+    def __init__(self, path: os.PathLike, pagenames: Sequence[Text], columnar: bool = True, cache=None):
+        self.path = path
+        self.pagenames = pagenames
+        self.columnar = columnar
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.pagenames)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        try:
+            if self.cache is not None:
+                return self.cache.page(self.path, self.pagenames[idx], self.columnar)
+            return RMPage(self.path, self.pagenames[idx], self.columnar)
+        except IndexError:
+            raise
+        except:
+            return None
 
 
 class RMPage:
-    def __init__(self, path: os.PathLike, pagename: Text):
-        if os.path.exists(os.path.join(path, f"{pagename}-metadata.json")):
-            with open(os.path.join(path, f"{pagename}-metadata.json")) as f:
-                self.metadata = json.loads(f.read())
-        else:
-            self.metadata = {}
+    def __init__(self, path: os.PathLike, pagename: Text, columnar: bool = True):
+        """
+        Open a page.
+
+        The .rm file is memory mapped and only the header and the offset of each layer
+        are read here. Layers are parsed on first access to `layers`, and everything is
+        released again by `close`.
+        """
+        self.columnar = columnar
+        self.metadata = self.read_metadata(path, pagename)
 
         with open(os.path.join(path, f"{pagename}.rm"), 'rb') as f:
-            title = str(f.read(43))
-            self.version = float(title.rsplit("=")[-1].split()[0])
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-            [self.n_layers] = struct.unpack('<i', f.read(4))
+        try:
+            self.version, self.n_layers = read_header(self._mm)
+            profiling.count('pages')
             if self.metadata and self.n_layers != len(self.metadata["layers"]):
                 raise ValueError(
                     "Layer mismatch between metadata and .rm file!")
 
-            self.layers: Iterable[RMLayer] = [RMLayer(
-                f, self.metadata['layers'][i] if self.metadata else f"layer {i}") for i in range(self.n_layers)]
+            self.layer_offsets = []
+            for _ in range(self.n_layers):
+                self.layer_offsets.append(self._mm.tell())
+                RMLayer.skip(self._mm)
+        except:
+            self.close()
+            raise
+
+        self._layers = None
+        self._stroke_refs = None
+        self._bboxes = None
+        self._index = None
+
+    @staticmethod
+    def read_metadata(path: os.PathLike, pagename: Text) -> dict:
+        """
+        Read the layer names of a page from its -metadata.json, or {} if it has none.
+        """
+        if os.path.exists(os.path.join(path, f"{pagename}-metadata.json")):
+            with open(os.path.join(path, f"{pagename}-metadata.json")) as f:
+                return json.loads(f.read())
+        return {}
+
+    def layer_name(self, idx: int) -> Text:
+        return self.metadata['layers'][idx] if self.metadata else f"layer {idx}"
+
+    @property
+    def layers(self) -> Sequence['RMLayer']:
+        if self._layers is None:
+            if self._mm is None:
+                raise ValueError("Page is closed")
+            self._mm.seek(self.layer_offsets[0] if self.layer_offsets else 0)
+            self._layers = [RMLayer(self._mm, self.layer_name(i), self.columnar) for i in range(self.n_layers)]
+        return self._layers
+
+    def iter_strokes(self, region=None, margin: float = STROKE_MARGIN):
+        """
+        Stream the strokes of the page without parsing layers, see iter_strokes.
+
+        Args:
+            region: If given, only strokes that may be visible in the region (x0, y0, x1, y1)
+                are read, found through `index`.
+            margin: Distance around region within which strokes count as visible, for their width.
+        """
+        if region is not None:
+            for i in self.index.query(*region, margin):
+                yield self.stroke(i)
+            return
+        yield from self._iter_all()
+
+    def _iter_all(self):
+        if self._mm is None:
+            raise ValueError("Page is closed")
+        if not self.layer_offsets:
+            return
+        self._mm.seek(self.layer_offsets[0])
+        yield from iter_strokes(self._mm, self.n_layers)
+
+    def _scan(self):
+        """
+        Find the offset and bounding box of every stroke, in one pass over the page.
+        """
+        if self._stroke_refs is not None:
+            return
+        if self._mm is None:
+            raise ValueError("Page is closed")
+        refs, bboxes = [], []
+        if self.layer_offsets:
+            self._mm.seek(self.layer_offsets[0])
+        for layer_idx in range(self.n_layers):
+            [n_strokes] = struct.unpack('<i', self._mm.read(4))
+            for _ in range(n_strokes):
+                refs.append((layer_idx, self._mm.tell()))
+                header = STROKE_HEADER.unpack(self._mm.read(STROKE_HEADER.size))
+                bboxes.append(points_bbox(decode_points(self._mm.read(POINT_SIZE * header[-1]))))
+        self._stroke_refs, self._bboxes = refs, bboxes
+
+    @property
+    def bboxes(self) -> List[tuple]:
+        """
+        Bounding box (min_x, min_y, max_x, max_y) of the points of every stroke, in drawing order.
+        """
+        self._scan()
+        return self._bboxes
+
+    @property
+    def index(self) -> StrokeGrid:
+        """
+        Spatial index of the strokes, built on first access.
+        Stroke indices count the strokes of all layers in drawing order, see `stroke`.
+        """
+        if self._index is None:
+            self._index = StrokeGrid(self.bboxes)
+        return self._index
+
+    def stroke(self, idx: int):
+        """
+        Read a single stroke.
+
+        Returns:
+            (layer_index, RMStrokeHeader, points) as yielded by iter_strokes.
+        """
+        self._scan()
+        if self._mm is None:
+            raise ValueError("Page is closed")
+        layer_idx, offset = self._stroke_refs[idx]
+        self._mm.seek(offset)
+        header = RMStrokeHeader._make(STROKE_HEADER.unpack(self._mm.read(STROKE_HEADER.size)))
+        return layer_idx, header, decode_points(self._mm.read(POINT_SIZE * header.n_points))
+
+    def strokes_at(self, x: float, y: float, radius: float = 0.) -> List[int]:
+        """
+        Hit test: find the strokes whose center line passes within radius of (x, y).
+
+        Returns:
+            Indices of the strokes in drawing order, see `stroke`.
+        """
+        hits = []
+        for i in self.index.query(x, y, x, y, radius):
+            _, _, data = self.stroke(i)
+            xs, ys = (list(c) for c in points_xy(data))
+            if len(xs) == 1:
+                xs, ys = xs * 2, ys * 2
+            if any(segment_distance(x, y, xs[k], ys[k], xs[k + 1], ys[k + 1]) <= radius for k in range(len(xs) - 1)):
+                hits.append(i)
+        return hits
+
+    def close(self):
+        """
+        Release the memory map and any parsed layers.
+        """
+        self._layers = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class RMLayer:
-    def __init__(self, f: BinaryIO, name: Text):
+    def __init__(self, f: BinaryIO, name: Text, columnar: bool = True):
         self.name = name
         [self.n_strokes] = struct.unpack('<i', f.read(4))
-        self.strokes: Iterable[RMStroke] = [RMStroke(f) for _ in range(self.n_strokes)]
+        self.strokes: Iterable[RMStroke] = [RMStroke(f, columnar) for _ in range(self.n_strokes)]
+
+    @classmethod
+    def from_strokes(cls, name: Text, strokes: Sequence['RMStroke']):
+        """
+        Create a layer from strokes that have already been read.
+        """
+        layer = cls.__new__(cls)
+        layer.name = name
+        layer.n_strokes = len(strokes)
+        layer.strokes = list(strokes)
+        return layer
+
+    @staticmethod
+    def skip(f: BinaryIO):
+        """
+        Move f past a layer without parsing its strokes.
+        """
+        [n_strokes] = struct.unpack('<i', f.read(4))
+        for _ in range(n_strokes):
+            header = STROKE_HEADER.unpack(f.read(STROKE_HEADER.size))
+            f.seek(POINT_SIZE * header[-1], os.SEEK_CUR)
 
 
 class RMStroke:
-    def __init__(self, f: BinaryIO):
-        [self.pen_type] = struct.unpack('<i', f.read(4))
-        [self.color] = struct.unpack('<i', f.read(4))
-        [self.unknown1] = struct.unpack('<i', f.read(4))
-        [self.base_size] = struct.unpack('<f', f.read(4))
-        [self.unknown2] = struct.unpack('<f', f.read(4))
-        [self.n_points] = struct.unpack('<i', f.read(4))
+    def __init__(self, f: BinaryIO, columnar: bool = True):
+        """
+        Read a stroke from f.
+
+        Args:
+            f: File positioned at the start of the stroke.
+            columnar: If True, the points are read as one block and stored in `data`,
+                and `points` is a lazy view over it. Otherwise one RMPoint is read at a time.
+        """
+        (self.pen_type, self.color, self.unknown1,
+         self.base_size, self.unknown2, self.n_points) = STROKE_HEADER.unpack(f.read(STROKE_HEADER.size))
+
+        if columnar:
+            self.data = decode_points(f.read(POINT_SIZE * self.n_points))
+            self._points = None
+        else:
+            self.data = None
+            self._points = [RMPoint(f) for _ in range(self.n_points)]
 
-        # print([self.pen_type, self.color, self.unknown1, self.base_size, self.unknown2, self.n_points])
-        self.points: Iterable[RMPoint] = [RMPoint(f) for _ in range(self.n_points)]
+    @classmethod
+    def from_header(cls, header: RMStrokeHeader, data):
+        """
+        Create a columnar stroke from the output of iter_strokes.
+        """
+        stroke = cls.__new__(cls)
+        (stroke.pen_type, stroke.color, stroke.unknown1,
+         stroke.base_size, stroke.unknown2, stroke.n_points) = header
+        stroke.data = data
+        stroke._points = None
+        return stroke
+
+    @property
+    def points(self) -> Sequence['RMPoint']:
+        if self._points is None:
+            self._points = RMPointView(self.data, self.n_points)
+        return self._points
+
+    def column(self, name: Text):
+        """
+        Get a single point attribute (one of POINT_FIELDS) for all points in the stroke.
+        """
+        if self.data is None:
+            return [getattr(p, name) for p in self._points]
+        if np is not None:
+            return self.data[name]
+        return self.data[POINT_FIELDS.index(name)::len(POINT_FIELDS)]
 
-        # print(max(map(lambda p: p.pressure, self.points)))
 
 class RMPoint:
     def __init__(self, f):
@@ -85,6 +485,46 @@ class RMPoint:
         [self.width] = struct.unpack('<f', f.read(4))
         [self.pressure] = struct.unpack('<f', f.read(4))
 
+    @classmethod
+    def from_values(cls, x, y, speed, direction, width, pressure):
+        p = cls.__new__(cls)
+        p.x, p.y, p.speed, p.direction, p.width, p.pressure = x, y, speed, direction, width, pressure
+        return p
+
+
+class RMPointView(Sequence):
+    """
+    Read-only sequence of RMPoints backed by columnar point data.
+    Points are created on access, so no per-point objects are kept alive.
+    """
+    def __init__(self, data, n_points: int):
+        self.data = data
+        self.n_points = n_points
+
+    def __len__(self):
+        return self.n_points
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.n_points))]
+        if idx < 0:
+            idx += self.n_points
+        if not 0 <= idx < self.n_points:
+            raise IndexError("point index out of range")
+
+        if np is not None:
+            return RMPoint.from_values(*self.data[idx].tolist())
+        n = len(POINT_FIELDS)
+        return RMPoint.from_values(*self.data[idx * n:(idx + 1) * n])
+
+    def __iter__(self) -> Iterator[RMPoint]:
+        n = len(POINT_FIELDS)
+        if np is not None:
+            values = self.data.tolist()
+        else:
+            values = (self.data[i:i + n] for i in range(0, len(self.data), n))
+        for v in values:
+            yield RMPoint.from_values(*v)
 
 
 if __name__ == "__main__":
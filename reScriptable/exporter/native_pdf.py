@@ -0,0 +1,221 @@
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Text, TextIO, Tuple
+
+import re
+import zlib
+
+from io import StringIO
+
+from .line_reader import RMDocument, RMPage, RMStroke
+from .svg_export import RMPen, RMToSVG
+from .. import profiling
+from .outline import stroke_outline
+from .spatial import visible_region
+from .templates import TemplateLibrary
+
+# Inkscape maps SVG pixels (96 dpi) to PDF points (72 dpi), do the same so pages match.
+PX_TO_PT = 72 / 96
+
+
+def parse_color(color: Text) -> Tuple[float, float, float]:
+    """
+    Convert a color as used in Colors to PDF rgb components in [0, 1].
+    """
+    match = re.fullmatch(r'\s*rgb\((\d+),\s*(\d+),\s*(\d+)\)\s*', color)
+    if match is None:
+        raise ValueError(f"Unsupported color: '{color}'")
+    return tuple(int(c) / 255 for c in match.groups())
+
+
+class PDFWriter:
+    """
+    Minimal PDF writer producing one vector content stream per page.
+    """
+    def __init__(self):
+        self.objects: List[bytes] = []
+        self.page_ids: List[int] = []
+        self.pages_id = self._reserve()
+        self.resources_id = self._reserve()
+        self.gstates: Dict[float, Text] = {}
+        self.images: Dict[object, Tuple[Text, int]] = {}
+
+    def _reserve(self) -> int:
+        self.objects.append(b'')
+        return len(self.objects)
+
+    def _set(self, obj_id: int, body: bytes):
+        self.objects[obj_id - 1] = body
+
+    def _add(self, body: bytes) -> int:
+        obj_id = self._reserve()
+        self._set(obj_id, body)
+        return obj_id
+
+    def gstate(self, opacity: float) -> Text:
+        """
+        Get the name of a graphics state with the given stroke and fill opacity.
+        """
+        if opacity not in self.gstates:
+            self.gstates[opacity] = f'GS{len(self.gstates)}'
+        return self.gstates[opacity]
+
+    def image(self, key, width: int, height: int, data: bytes) -> Text:
+        """
+        Get the name of an image, adding it to the document if it is not there yet.
+
+        Args:
+            key: Identifies the image, it is only added once per key.
+            data: zlib compressed 8 bit gray pixels, row by row from the top.
+        """
+        if key not in self.images:
+            obj_id = self._add((
+                f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray '
+                f'/BitsPerComponent 8 /Filter /FlateDecode /Length {len(data)} >>\nstream\n').encode('latin-1')
+                + data + b'\nendstream')
+            self.images[key] = (f'Im{len(self.images)}', obj_id)
+        return self.images[key][0]
+
+    def add_page(self, width: float, height: float, content: Text):
+        stream = zlib.compress(content.encode('latin-1'))
+        content_id = self._add(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        page_id = self._add((
+            f'<< /Type /Page /Parent {self.pages_id} 0 R /MediaBox [0 0 {width:.2f} {height:.2f}] '
+            f'/Contents {content_id} 0 R /Resources {self.resources_id} 0 R >>').encode('latin-1'))
+        self.page_ids.append(page_id)
+
+    def write(self, out: BinaryIO):
+        gstates = " ".join(f'/{name} << /CA {opacity} /ca {opacity} >>' for opacity, name in self.gstates.items())
+        images = " ".join(f'/{name} {obj_id} 0 R' for name, obj_id in self.images.values())
+        self._set(self.resources_id, f'<< /ExtGState << {gstates} >> /XObject << {images} >> >>'.encode('latin-1'))
+
+        kids = " ".join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self._set(self.pages_id, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>'.encode('latin-1'))
+        catalog_id = self._add(f'<< /Type /Catalog /Pages {self.pages_id} 0 R >>'.encode('latin-1'))
+
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        pos = 15
+        offsets = []
+        for i, body in enumerate(self.objects):
+            offsets.append(pos)
+            data = b'%d 0 obj\n' % (i + 1) + body + b'\nendobj\n'
+            out.write(data)
+            pos += len(data)
+
+        out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.objects) + 1))
+        for offset in offsets:
+            out.write(b'%010d 00000 n \n' % offset)
+        out.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(self.objects) + 1, catalog_id, pos))
+
+
+class RMPdfPen(RMPen):
+    """
+    Pen drawing strokes as PDF path operators instead of SVG elements.
+    Widths and opacities are computed by RMPen.draw, so the output matches the SVG export.
+    """
+    def __init__(self, idx, output: TextIO, cmap, writer: PDFWriter, simplify: Optional[float] = None, width_step: float = .5,
+                 variable_width: Text = 'outline'):
+        super().__init__(idx, output, cmap, simplify, width_step, variable_width)
+        self.writer = writer
+
+    def _style(self, color: Text, width: float, opacity: float):
+        r, g, b = parse_color(color)
+        self.output.write(f'/{self.writer.gstate(opacity)} gs {r:.3f} {g:.3f} {b:.3f} RG {width:.3f} w\n')
+
+    def draw_single(self, points: Iterable[Tuple[float, float]], color: Text, width: float, opacity: float):
+        self.output.write('q ')
+        self._style(color, width, opacity)
+        self._path(points)
+        self.output.write('S Q\n')
+
+    def draw_combined(self, points: Iterable[Tuple[float, float, float, float, Text]], eps: float = 1e-8):
+        for i, p in enumerate(points[1:-1]):
+            last_p = points[i]
+            next_p = points[i+2]
+            w = sum([last_p[2], p[2], next_p[2]]) / 3.
+            self.output.write('q ')
+            self._style(p[4], w, p[3])
+            self._path([last_p, p, next_p])
+            self.output.write('S Q\n')
+
+    def draw_outline(self, points: Iterable[Tuple[float, float, float, float, Text]]):
+        outline = stroke_outline(points)
+        if not outline:
+            return
+        r, g, b = parse_color(points[0][4])
+        self.output.write(f'q /{self.writer.gstate(points[0][3])} gs {r:.3f} {g:.3f} {b:.3f} rg\n')
+        ops = 'm'
+        for x, y in outline:
+            self.output.write(f'{x:.1f} {y:.1f} {ops} ')
+            ops = 'l'
+        self.output.write('h f Q\n')
+
+    def _path(self, points):
+        ops = 'm'
+        for p in points:
+            self.output.write(f'{round(p[0])} {round(p[1])} {ops} ')
+            ops = 'l'
+
+
+class RMToNativePDF:
+    """
+    Writes a document to PDF in-process, without going through SVG, inkscape and pdftk.
+    """
+    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872,
+                 simplify: Optional[float] = None, width_step: float = .5, variable_width: Text = 'outline',
+                 templates: Optional[TemplateLibrary] = None):
+        self.doc = doc
+        self.width = width
+        self.height = height
+        self.simplify = simplify
+        self.width_step = width_step
+        self.variable_width = variable_width
+        self.templates = templates
+
+        self.colormap = dict(RMToSVG.COLORMAP)
+
+    def _page_content(self, page: Optional[RMPage], writer: PDFWriter, fill_bg: bool = True,
+                      width: Optional[int] = None, height: Optional[int] = None, template: Optional[Text] = None) -> Text:
+        width = width if width is not None else self.width
+        height = height if height is not None else self.height
+        output = StringIO()
+        # Flip the y axis and scale, so strokes can be drawn in .rm coordinates
+        output.write(f'{PX_TO_PT:.4f} 0 0 {-PX_TO_PT:.4f} 0 {height * PX_TO_PT:.2f} cm\n')
+
+        if fill_bg:
+            output.write(f'1 1 1 rg 0 0 {width} {height} re f\n')
+            if template is not None and self.templates is not None:
+                data = self.templates.pdf_image(template, width, height)
+                if data is not None:
+                    name = writer.image((self.templates.key(template), width, height), width, height, data)
+                    # Images fill the unit square, upside down in the flipped coordinates
+                    output.write(f'q {width} 0 0 {-height} 0 {height} cm /{name} Do Q\n')
+
+        if page is not None:
+            for _, header, data in page.iter_strokes(visible_region(width, height)):
+                pen = RMPdfPen(header.pen_type, output, self.colormap, writer, self.simplify, self.width_step,
+                               self.variable_width)
+                pen.draw(RMStroke.from_header(header, data))
+        return output.getvalue()
+
+    def write(self, out: BinaryIO, fill_bg: bool = True, pages: Optional[Sequence[int]] = None,
+              sizes: Optional[Sequence[Tuple[int, int]]] = None):
+        """
+        Write the document as PDF to out.
+
+        Args:
+            pages: Indices of the pages to write, all pages by default.
+            sizes: (width, height) of each page in pages, if they differ from the document's size.
+        """
+        with profiling.timer('native_pdf'):
+            writer = PDFWriter()
+            if pages is None:
+                pages = range(len(self.doc.pages))
+            for k, i in enumerate(pages):
+                width, height = sizes[k] if sizes is not None else (self.width, self.height)
+                page = self.doc.pages[i]
+                try:
+                    writer.add_page(width * PX_TO_PT, height * PX_TO_PT,
+                                    self._page_content(page, writer, fill_bg, width, height, self.doc.template(i)))
+                finally:
+                    if page is not None:
+                        page.close()
+            writer.write(out)
@@ -0,0 +1,36 @@
+from typing import List, Sequence, Tuple
+
+import math
+
+
+def stroke_outline(points: Sequence[Tuple[float, float, float]]) -> List[Tuple[float, float]]:
+    """
+    Compute the outline of a variable width line as a single polygon.
+
+    Each point (x, y, width, ...) is offset by half its width on both sides, perpendicular
+    to the direction of the line at that point. The polygon runs along one side of the
+    line and back along the other.
+
+    Returns:
+        The corners of the polygon, or an empty list if the line has less than two points.
+    """
+    n = len(points)
+    if n < 2:
+        return []
+
+    left, right = [], []
+    nx, ny = 0., 0.
+    for i in range(n):
+        prev_p = points[max(i - 1, 0)]
+        next_p = points[min(i + 1, n - 1)]
+        tx, ty = next_p[0] - prev_p[0], next_p[1] - prev_p[1]
+        length = math.hypot(tx, ty)
+        if length > 0:
+            # Keep the previous normal where the line stands still
+            nx, ny = -ty / length, tx / length
+
+        x, y, half = points[i][0], points[i][1], points[i][2] / 2
+        left.append((x + nx * half, y + ny * half))
+        right.append((x - nx * half, y - ny * half))
+
+    return left + right[::-1]
@@ -0,0 +1,109 @@
+from typing import Optional, Text
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+class PageCache:
+    """
+    Persistent cache of rendered pages, stored as one file per page in a directory.
+
+    Entries are keyed by a hash of the page's .rm file and the settings it was rendered
+    with. Reading an entry marks it as recently used, and `evict` removes the least
+    recently used entries until the cache fits in max_bytes.
+    """
+    def __init__(self, directory: os.PathLike, max_bytes: int = 512 * 1024 * 1024, suffix: Text = '.pdf'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(rm_path: Optional[os.PathLike], **settings) -> Text:
+        """
+        Compute the cache key of a page.
+
+        Args:
+            rm_path: The .rm file of the page, or None for a page without strokes.
+            settings: Anything else that affects the rendered page, e.g. size and background.
+        """
+        h = hashlib.sha256()
+        if rm_path is not None and os.path.exists(rm_path):
+            with open(rm_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        h.update(b'\0')
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key: Text) -> Text:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key: Text) -> Optional[Text]:
+        """
+        Get the path of a cached page, or None if it is not cached.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fetch(self, key: Text, dst: os.PathLike) -> bool:
+        """
+        Copy a cached page to dst.
+
+        Returns:
+            False if the page is not cached.
+        """
+        path = self.get(key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, dst)
+        except FileNotFoundError:
+            # Evicted by someone else in the meantime
+            return False
+        return True
+
+    def put(self, key: Text, src: os.PathLike) -> Text:
+        """
+        Copy the rendered page src into the cache.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, self.path(key))
+        except:
+            os.remove(tmp_path)
+            raise
+        return self.path(key)
+
+    def evict(self):
+        """
+        Remove the least recently used pages until the cache is at most max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
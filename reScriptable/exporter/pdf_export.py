@@ -1,66 +1,314 @@
 
 from .svg_export import RMToSVG
+from .native_pdf import RMToNativePDF
+from .page_cache import PageCache
 from .line_reader import RMDocument
+from .templates import TemplateLibrary
+from .. import profiling
 
 import os
 import subprocess
 import shutil
 import sys
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Page sizes of background PDFs, keyed by the identity and version of the file
+_page_sizes: Dict[tuple, List[Tuple[float, float]]] = {}
+
+
+def pdf_page_sizes(pdf) -> List[Tuple[float, float]]:
+    """
+    Get the size in points of every page of a PDF, with the page rotation applied.
+
+    The media boxes of all pages are read by a single pdfinfo call, and kept for as long as
+    the file is unchanged. Snapshots hard link unchanged files, so this also holds across snapshots.
+    """
+    st = os.stat(pdf)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key in _page_sizes:
+        return _page_sizes[key]
+
+    with profiling.timer('pdfinfo'):
+        res = subprocess.run(["pdfinfo", "-box", "-f", "1", "-l", str(2 ** 31 - 1), pdf],
+                             capture_output=True, text=True)
+    boxes, rotations = {}, {}
+    for line in res.stdout.split("\n"):
+        data = line.strip().lower().split()
+        if len(data) < 4 or data[0] != 'page' or not data[1].isdigit():
+            continue
+        if data[2] == 'mediabox:' and len(data) >= 7:
+            x0, y0, x1, y1 = map(float, data[3:7])
+            boxes[int(data[1])] = (abs(x1 - x0), abs(y1 - y0))
+        elif data[2] == 'rot:':
+            rotations[int(data[1])] = int(float(data[3]))
+
+    sizes = []
+    for n in sorted(boxes):
+        w, h = boxes[n]
+        sizes.append((h, w) if rotations.get(n, 0) % 180 == 90 else (w, h))
+    _page_sizes[key] = sizes
+    return sizes
+
+
+def _pdftk(args: List[str]):
+    """
+    Run pdftk, raising OSError if it fails so the document is reported as failed instead of
+    leaving a missing or partial output.
+    """
+    res = subprocess.run(['/usr/bin/pdftk'] + args)
+    if res.returncode != 0:
+        raise OSError(f"pdftk returned code: {res.returncode}")
+
 
 class RMToPDF:
-    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872):
+    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872, jobs: Optional[int] = None,
+                 cache: Optional[PageCache] = None, simplify: Optional[float] = None,
+                 variable_width: str = 'outline', templates: Optional[TemplateLibrary] = None):
+        """
+        Args:
+            doc: The document to export.
+            width, height: Maximum page size.
+            jobs: Number of pages converted concurrently, defaults to the number of CPUs.
+            cache: Cache of rendered pages. Pages found in it are not rendered again
+                by the inkscape backend. It is not evicted, that is up to the caller.
+            simplify: Tolerance in pixels for stroke simplification, see RMPen.
+            variable_width: How variable width strokes are drawn, see RMPen.
+            templates: Templates drawn on the pages of documents without a background PDF.
+        """
         self.doc = doc
         self.width = width
         self.height = height
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.cache = cache
+        self.simplify = simplify
+        self.variable_width = variable_width
+        self.templates = templates
 
-    def get_pdf_size(self, pdf):
+        self.timings: Dict[str, float] = {}
+
+    def get_pdf_size(self, pdf, page: int = 0):
+        """
+        Size of the overlay for a page of the background PDF: the page scaled to fit in width x height.
+        """
         if pdf is not None:
-            res = subprocess.run(["pdfinfo", "-box", pdf], capture_output=True, text=True)
-            w, h = None, None
-            for line in res.stdout.split("\n"):
-                nice = line.strip().lower()
-                if nice.startswith("mediabox"):
-                    data = nice.split()
-                    w, h = float(data[-2]), float(data[-1])
-            if w is None:
+            sizes = pdf_page_sizes(pdf)
+            if not sizes:
                 print("Warning: MediaBox not found in pdfinfo output!", file=sys.stderr)
             else:
-                w_frac = self.width / w
-                h_frac = self.height / h
-                m_frac = min(w_frac, h_frac)
-
-                return round(w * m_frac), round(h * m_frac)
+                return self._fit(*sizes[min(page, len(sizes) - 1)])
         return self.width, self.height
 
-    def write(self, out):
+    def _fit(self, w, h):
+        w_frac = self.width / w
+        h_frac = self.height / h
+        m_frac = min(w_frac, h_frac)
+
+        return round(w * m_frac), round(h * m_frac)
+
+    @staticmethod
+    def _convert_page(tmp_out_dir, i):
+        with profiling.timer('inkscape'):
+            proc = subprocess.Popen(['/usr/bin/inkscape', '--without-gui', f'--export-filename={os.path.join(tmp_out_dir, "pdf" + str(i) + ".pdf")}', os.path.join(tmp_out_dir, "p" + str(i) + ".svg")], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            proc.communicate()
+        if proc.returncode < 0:
+            raise OSError(f"Popen return code: {proc.returncode}")
+
+    def write(self, out, backend: str = 'inkscape', annotated_only: bool = True):
+        """
+        Write the document to the PDF file out.
+
+        Args:
+            out: Path of the PDF.
+            backend: 'inkscape' to render pages through SVG with inkscape, or 'native' to
+                write the strokes directly as PDF paths. pdftk is still used to stamp
+                the pages onto a background PDF.
+            annotated_only: For documents with a background PDF, only render and stamp the pages
+                that have strokes, each at the size of its own page, and copy the others through
+                unchanged. Otherwise every page is stamped with an overlay sized for the first page.
+
+        Returns:
+            Seconds spent in each step of the export, also available as self.timings.
+        """
         os.makedirs(os.path.dirname(out), exist_ok=True)
         n_pages = self.doc.content_data['pageCount']
         bg = self.doc.pdf
 
+        self.timings = {}
+        start = time.perf_counter()
+
+        if backend not in ('inkscape', 'native'):
+            raise ValueError(f"Unknown PDF backend: '{backend}'")
+
+        if bg is not None and annotated_only:
+            sizes = pdf_page_sizes(bg)
+            if len(sizes) == n_pages:
+                return self._write_annotated(out, bg, backend, [self._fit(w, h) for w, h in sizes], start)
+            print(f"Warning: {bg} has {len(sizes)} pages, but the document has {n_pages}, stamping all pages",
+                  file=sys.stderr)
+
         width, height = self.get_pdf_size(bg)
 
-        to_svg = RMToSVG(self.doc, width, height)
+        if backend == 'native':
+            return self._write_native(out, bg, width, height, start)
 
-        tmp_out_dir = ".rm_pdf_export_tmp"
-        to_svg.write(tmp_out_dir, bg is None)
+        tmp_out_dir = tempfile.mkdtemp(prefix="rm_pdf_export_")
+        try:
+            page_files = self._render_pages(tmp_out_dir, range(n_pages), [(width, height)] * n_pages, bg is None, start)
+            start = time.perf_counter()
 
-        for i in range(1, n_pages+1):
-            proc = subprocess.Popen(['/usr/bin/inkscape', '--without-gui', f'--export-filename={os.path.join(tmp_out_dir, "pdf" + str(i) + ".pdf")}', os.path.join(tmp_out_dir, "p" + str(i) + ".svg")], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-            proc.communicate()
-            if proc.returncode < 0:
-                raise OSError(f"Popen return code: {proc.returncode}")
+            merged_path = os.path.join(tmp_out_dir, 'merged.pdf')
+            with profiling.timer('pdftk'):
+                _pdftk(page_files + ['cat', 'output', merged_path])
+            start = self._lap('merge', start)
+
+            if bg is None:
+                shutil.copy(merged_path, out)
+            else:
+                with profiling.timer('pdftk'):
+                    _pdftk([bg, 'multistamp', merged_path, 'output', out])
+            self._lap('stamp', start)
+        finally:
+            shutil.rmtree(tmp_out_dir)
+
+        return self.timings
 
-        merged_path = os.path.join(tmp_out_dir, 'merged.pdf')
-        proc = subprocess.run(['/usr/bin/pdftk'] + [os.path.join(tmp_out_dir, f"pdf{i}.pdf") for i in range(1, n_pages + 1)] + ['cat', 'output', merged_path])
+    def _write_native(self, out, bg, width, height, start):
+        to_pdf = RMToNativePDF(self.doc, width, height, self.simplify, variable_width=self.variable_width,
+                               templates=self.templates)
 
         if bg is None:
-            shutil.copy(merged_path, out)
-        else:
-            subprocess.run(['/usr/bin/pdftk', bg, 'multistamp', merged_path, 'output', out])
+            with open(out, 'wb') as f:
+                to_pdf.write(f, True)
+            self._lap('convert', start)
+            return self.timings
+
+        tmp_out_dir = tempfile.mkdtemp(prefix="rm_pdf_export_")
+        try:
+            merged_path = os.path.join(tmp_out_dir, 'merged.pdf')
+            with open(merged_path, 'wb') as f:
+                to_pdf.write(f, False)
+            start = self._lap('convert', start)
+
+            with profiling.timer('pdftk'):
+                _pdftk([bg, 'multistamp', merged_path, 'output', out])
+            self._lap('stamp', start)
+        finally:
+            shutil.rmtree(tmp_out_dir)
+
+        return self.timings
+
+    def _write_annotated(self, out, bg, backend, sizes, start):
+        """
+        Stamp overlays onto the annotated pages of bg only, see write.
+
+        Args:
+            sizes: Overlay size of every page, as returned by get_pdf_size.
+        """
+        n_pages = len(sizes)
+        annotated = [i for i in range(n_pages) if self.doc.is_annotated(i)]
+        profiling.count('pages_annotated', len(annotated))
+        profiling.count('pages_copied', n_pages - len(annotated))
+        if not annotated:
+            shutil.copy(bg, out)
+            self._lap('stamp', start)
+            return self.timings
+
+        tmp_out_dir = tempfile.mkdtemp(prefix="rm_pdf_export_")
+        try:
+            overlay_path = os.path.join(tmp_out_dir, 'overlay.pdf')
+            if backend == 'native':
+                to_pdf = RMToNativePDF(self.doc, self.width, self.height, self.simplify,
+                                       variable_width=self.variable_width)
+                with open(overlay_path, 'wb') as f:
+                    to_pdf.write(f, False, annotated, [sizes[i] for i in annotated])
+                start = self._lap('convert', start)
+            else:
+                page_files = self._render_pages(tmp_out_dir, annotated, [sizes[i] for i in annotated], False, start)
+                start = time.perf_counter()
+                with profiling.timer('pdftk'):
+                    _pdftk(page_files + ['cat', 'output', overlay_path])
+                start = self._lap('merge', start)
+
+            # Stamp the annotated pages on their own, then put them back between the untouched ones
+            subset_path = os.path.join(tmp_out_dir, 'subset.pdf')
+            stamped_path = os.path.join(tmp_out_dir, 'stamped.pdf')
+            with profiling.timer('pdftk'):
+                _pdftk([bg, 'cat'] + [str(i + 1) for i in annotated] + ['output', subset_path])
+                _pdftk([subset_path, 'multistamp', overlay_path, 'output', stamped_path])
+                _pdftk([f'A={bg}', f'B={stamped_path}', 'cat'] + _page_ranges(n_pages, annotated) + ['output', out])
+            self._lap('stamp', start)
+        finally:
+            shutil.rmtree(tmp_out_dir)
+
+        return self.timings
+
+    def _render_pages(self, tmp_out_dir, pages, sizes, fill_bg, start):
+        """
+        Render pages through SVG and inkscape, each at its own size, using the page cache if any.
+
+        Returns:
+            Paths of the rendered PDFs, in the order of pages.
+        """
+        page_files = [os.path.join(tmp_out_dir, f"pdf{i + 1}.pdf") for i in pages]
+        keys = [None] * len(pages)
+        missing = list(range(len(pages)))
+        if self.cache is not None:
+            keys = [PageCache.key(self.doc.page_path(i), width=w, height=h, fill_bg=fill_bg,
+                                  simplify=self.simplify, variable_width=self.variable_width,
+                                  template=self._template_key(i, fill_bg))
+                    for i, (w, h) in zip(pages, sizes)]
+            missing = [k for k in missing if not self.cache.fetch(keys[k], page_files[k])]
+            profiling.count('page_cache_hits', len(pages) - len(missing))
+
+        for k in missing:
+            w, h = sizes[k]
+            # inkscape reads the templates from disk, no need to embed them in every page
+            RMToSVG(self.doc, w, h, self.simplify, variable_width=self.variable_width,
+                    templates=self.templates, embed_templates=False).write(tmp_out_dir, fill_bg, [pages[k]])
+        start = self._lap('svg', start)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # list() re-raises the first failure, if any
+            list(executor.map(lambda k: self._convert_page(tmp_out_dir, pages[k] + 1), missing))
+        if self.cache is not None:
+            for k in missing:
+                self.cache.put(keys[k], page_files[k])
+        self._lap('convert', start)
+        return page_files
+
+    def _template_key(self, idx, fill_bg):
+        if not fill_bg or self.templates is None:
+            return None
+        return self.templates.key(self.doc.template(idx))
+
+    def _lap(self, step, start):
+        now = time.perf_counter()
+        self.timings[step] = now - start
+        return now
+
 
-        shutil.rmtree(tmp_out_dir)
+def _page_ranges(n_pages: int, annotated: Sequence[int]) -> List[str]:
+    """
+    pdftk page ranges taking the pages in annotated from handle B, in order, and all others from A.
+    """
+    ranges = []
+    stamped = {i: k for k, i in enumerate(annotated)}
+    i = 0
+    while i < n_pages:
+        if i in stamped:
+            ranges.append(f"B{stamped[i] + 1}")
+            i += 1
+            continue
+        first = i
+        while i < n_pages and i not in stamped:
+            i += 1
+        ranges.append(f"A{first + 1}" if i - first == 1 else f"A{first + 1}-{i}")
+    return ranges
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+from .decoded_cache import DecodedPageCache
+from .line_reader import RMDocument, RMPage, RMStroke
+from .outline import stroke_outline
+from .spatial import visible_region
+from .templates import TemplateLibrary
+from .svg_export import RMPen, RMToSVG
+from .. import profiling
+
+import os
+
+from typing import Iterable, Optional, Sequence, Text, Tuple
+
+try:
+    from PIL import Image, ImageColor, ImageDraw
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RMRasterPen(RMPen):
+    """
+    Pen drawing strokes into a Pillow image.
+    Widths and opacities are computed by RMPen.draw, so the output matches the SVG export.
+    """
+    def __init__(self, idx, output: 'Image.Image', cmap, scale: float = 1., simplify: Optional[float] = None,
+                 width_step: float = .5, variable_width: Text = 'outline'):
+        """
+        Args:
+            output: The image to draw to.
+            scale: Pixels in the image per .rm pixel.
+        """
+        super().__init__(idx, output, cmap, simplify, width_step, variable_width)
+        self.scale = scale
+        self.draw_ctx = ImageDraw.Draw(output)
+
+    def draw_single(self, points: Iterable[Tuple[float, float]], color: Text, width: float, opacity: float):
+        xy = [(p[0] * self.scale, p[1] * self.scale) for p in points]
+        width = max(1, round(width * self.scale))
+        self._paint(xy, color, opacity, width / 2,
+                    lambda draw, xy, fill: draw.line(xy, fill=fill, width=width, joint='curve'))
+
+    def draw_combined(self, points: Iterable[Tuple[float, float, float, float, Text]], eps: float = 1e-8):
+        for i, p in enumerate(points[1:-1]):
+            last_p = points[i]
+            next_p = points[i+2]
+            w = sum([last_p[2], p[2], next_p[2]]) / 3.
+            self.draw_single((last_p, p, next_p), p[4], w, p[3])
+
+    def draw_outline(self, points: Iterable[Tuple[float, float, float, float, Text]]):
+        outline = stroke_outline(points)
+        if not outline:
+            return
+        xy = [(x * self.scale, y * self.scale) for x, y in outline]
+        self._paint(xy, points[0][4], points[0][3], 1, lambda draw, xy, fill: draw.polygon(xy, fill=fill))
+
+    def _paint(self, xy, color, opacity, margin, shape):
+        """
+        Draw shape(draw, xy, fill) directly if it is opaque, or otherwise through a mask covering
+        only its bounding box, so that it is blended with what is already drawn.
+        """
+        if opacity >= 1:
+            shape(self.draw_ctx, xy, color)
+            return
+
+        xs = [p[0] for p in xy]
+        ys = [p[1] for p in xy]
+        left = max(int(min(xs) - margin) - 1, 0)
+        top = max(int(min(ys) - margin) - 1, 0)
+        right = min(int(max(xs) + margin) + 2, self.output.width)
+        bottom = min(int(max(ys) + margin) + 2, self.output.height)
+        if left >= right or top >= bottom:
+            return
+
+        mask = Image.new('L', (right - left, bottom - top))
+        shape(ImageDraw.Draw(mask), [(x - left, y - top) for x, y in xy], round(255 * opacity))
+        self.output.paste(ImageColor.getrgb(color), (left, top, right, bottom), mask)
+
+
+class RMToPNG:
+    """
+    Rasterizes pages directly with Pillow, for previews and thumbnails without the PDF chain.
+    """
+    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872, scale: float = 1.,
+                 supersample: int = 1, simplify: Optional[float] = None, width_step: float = .5,
+                 variable_width: Text = 'outline', templates: Optional[TemplateLibrary] = None):
+        """
+        Args:
+            doc: The document to export.
+            width, height: Page size in .rm pixels.
+            scale: Size of the image relative to the page, see thumbnail_scale.
+            supersample: Draw at this many times the size and scale down, to smooth edges.
+            simplify, width_step, variable_width: How strokes are drawn, see RMPen.
+            templates: If given, pages with a filled background get their template from it.
+        """
+        if Image is None:
+            raise ImportError("Pillow is required for PNG export")
+
+        self.doc = doc
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.supersample = supersample
+        self.simplify = simplify
+        self.width_step = width_step
+        self.variable_width = variable_width
+        self.templates = templates
+
+        self.colormap = dict(RMToSVG.COLORMAP)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return max(1, round(self.width * self.scale)), max(1, round(self.height * self.scale))
+
+    def render(self, page: Optional[RMPage], fill_bg: bool = True, template: Optional[Text] = None) -> 'Image.Image':
+        """
+        Draw one page, or an empty page if page is None.
+
+        Args:
+            template: Name of the template drawn on the background, if fill_bg is set.
+
+        Returns:
+            An RGB image, or RGBA with a transparent background if fill_bg is False.
+        """
+        with profiling.timer('raster'):
+            w, h = self.size
+            scale = self.scale * self.supersample
+            background = None
+            if fill_bg and template is not None and self.templates is not None:
+                background = self.templates.image(template, w * self.supersample, h * self.supersample)
+            if background is not None:
+                image = background.copy()
+            elif fill_bg:
+                image = Image.new('RGB', (w * self.supersample, h * self.supersample), 'white')
+            else:
+                image = Image.new('RGBA', (w * self.supersample, h * self.supersample), (255, 255, 255, 0))
+
+            if page is not None:
+                for _, header, data in page.iter_strokes(visible_region(self.width, self.height)):
+                    pen = RMRasterPen(header.pen_type, image, self.colormap, scale, self.simplify,
+                                      self.width_step, self.variable_width)
+                    pen.draw(RMStroke.from_header(header, data))
+
+            if self.supersample > 1:
+                image = image.resize((w, h), Image.LANCZOS)
+        return image
+
+    def to_array(self, page: Optional[RMPage], fill_bg: bool = True):
+        """
+        Draw one page into a numpy array of shape (height, width, channels).
+        """
+        if np is None:
+            raise ImportError("numpy is required for to_array")
+        return np.asarray(self.render(page, fill_bg))
+
+    def write(self, out: Text, fill_bg: bool = True, pages: Optional[Sequence[int]] = None):
+        """
+        Write pages to out/p{i + 1}.png.
+
+        Args:
+            pages: Indices of the pages to write, all pages by default.
+        """
+        os.makedirs(out, exist_ok=True)
+        for i in pages if pages is not None else range(len(self.doc.pages)):
+            page = self.doc.pages[i]
+            try:
+                self.render(page, fill_bg, self.doc.template(i)).save(os.path.join(out, f"p{i + 1}.png"))
+            finally:
+                if page is not None:
+                    page.close()
+
+
+def thumbnail_scale(max_size: int, width: int = 1404, height: int = 1872) -> float:
+    """
+    The scale at which a width x height page fits in a max_size x max_size square.
+    """
+    return max_size / max(width, height)
+
+
+def write_thumbnail(rm_path, uuid, out_name, max_size=256, page=0, supersample=2, decoded_cache_dir=None):
+    """
+    Render one page of a document, by default the first, to a PNG of at most max_size pixels.
+    Documents without pages are written as a blank page.
+
+    Args:
+        decoded_cache_dir: Directory of a DecodedPageCache to load the page through, if any.
+    """
+    decoded = DecodedPageCache(decoded_cache_dir) if decoded_cache_dir is not None else None
+    doc = RMDocument(rm_path, uuid, cache=decoded)
+    to_png = RMToPNG(doc, scale=thumbnail_scale(max_size), supersample=supersample)
+    rm_page = doc.pages[page] if page < len(doc.pages) else None
+    try:
+        image = to_png.render(rm_page)
+    finally:
+        if rm_page is not None:
+            rm_page.close()
+    os.makedirs(os.path.dirname(out_name) or '.', exist_ok=True)
+    tmp_name = out_name + '.tmp'
+    image.save(tmp_name, 'PNG')
+    os.replace(tmp_name, out_name)
+
+
+if __name__ == "__main__":
+    doc = RMDocument('sample_files/CalligraphyTest',
+                     'a4e0a733-41d6-4f1a-b5eb-c6c066be990b')
+    RMToPNG(doc).write('out')
@@ -0,0 +1,76 @@
+from typing import List, Sequence, Tuple
+
+
+def rdp(points: Sequence[Tuple], tolerance: float) -> List[Tuple]:
+    """
+    Simplify a polyline with the Ramer-Douglas-Peucker algorithm.
+
+    Args:
+        points: The points of the line. Only the first two values, (x, y), of each point are used,
+            the rest are kept as they are.
+        tolerance: Maximum distance in pixels between the original and the simplified line.
+
+    Returns:
+        The points that are kept, in order. The first and last points are always kept.
+    """
+    n = len(points)
+    if n < 3:
+        return list(points)
+
+    tol_sq = tolerance * tolerance
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        ax, ay = points[start][0], points[start][1]
+        dx, dy = points[end][0] - ax, points[end][1] - ay
+        norm_sq = dx * dx + dy * dy
+
+        max_dist_sq, max_idx = -1., -1
+        for i in range(start + 1, end):
+            px, py = points[i][0] - ax, points[i][1] - ay
+            if norm_sq == 0:
+                dist_sq = px * px + py * py
+            else:
+                cross = dx * py - dy * px
+                dist_sq = cross * cross / norm_sq
+            if dist_sq > max_dist_sq:
+                max_dist_sq, max_idx = dist_sq, i
+
+        if max_dist_sq > tol_sq:
+            keep[max_idx] = True
+            stack.append((start, max_idx))
+            stack.append((max_idx, end))
+
+    return [p for p, k in zip(points, keep) if k]
+
+
+def width_runs(points: Sequence[Tuple[float, float, float]], width_step: float) -> List[Tuple[float, List[Tuple]]]:
+    """
+    Split a variable width line into runs of constant width.
+
+    Widths (the third value of each point) are rounded to a multiple of width_step, and consecutive
+    points in the same bucket are merged. Neighbouring runs share their end points, so no gaps appear.
+
+    Returns:
+        List of (width, points) for every run.
+    """
+    if not points:
+        return []
+
+    bucket = lambda w: max(width_step, round(w / width_step) * width_step)
+
+    runs = []
+    cur_width = bucket(points[0][2])
+    run = [points[0]]
+    for p in points[1:]:
+        run.append(p)
+        w = bucket(p[2])
+        if w != cur_width:
+            runs.append((cur_width, run))
+            cur_width, run = w, [p]
+    if len(run) > 1:
+        runs.append((cur_width, run))
+    return runs
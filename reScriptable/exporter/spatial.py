@@ -0,0 +1,89 @@
+from typing import List, Optional, Sequence, Tuple
+
+import math
+
+PAGE_WIDTH = 1404
+PAGE_HEIGHT = 1872
+
+# Bounding boxes only cover the points of a stroke. The widest pen, the largest highlighter,
+# reaches 12.5 pixels beyond them, see RMPen.draw.
+STROKE_MARGIN = 13
+
+BBox = Tuple[float, float, float, float]
+
+
+def intersects(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def visible_region(width: float, height: float) -> Optional[BBox]:
+    """
+    The region of the page shown on a width x height canvas, or None if it shows the whole page.
+    Strokes outside of it are clipped anyway, so they can be skipped when rendering.
+    """
+    if width >= PAGE_WIDTH and height >= PAGE_HEIGHT:
+        return None
+    return 0, 0, width, height
+
+
+def segment_distance(px: float, py: float, x0: float, y0: float, x1: float, y1: float) -> float:
+    """
+    Distance from (px, py) to the line segment from (x0, y0) to (x1, y1).
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    t = 0. if length2 == 0 else min(max(((px - x0) * dx + (py - y0) * dy) / length2, 0.), 1.)
+    return math.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+
+
+class StrokeGrid:
+    """
+    Uniform grid over a page, mapping each cell to the strokes whose bounding box overlaps it.
+
+    Strokes outside of the page are put in the nearest cells, so nothing is lost, queries
+    just get slower for them.
+    """
+    def __init__(self, bboxes: Sequence[BBox], width: int = PAGE_WIDTH, height: int = PAGE_HEIGHT,
+                 cell_size: int = 128):
+        """
+        Args:
+            bboxes: (min_x, min_y, max_x, max_y) of every stroke, in drawing order.
+        """
+        self.bboxes = list(bboxes)
+        self.cell_size = cell_size
+        self.cols = max(1, math.ceil(width / cell_size))
+        self.rows = max(1, math.ceil(height / cell_size))
+
+        self.cells: List[List[int]] = [[] for _ in range(self.cols * self.rows)]
+        for i, bbox in enumerate(self.bboxes):
+            c0, r0, c1, r1 = self._cell_range(bbox)
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    self.cells[r * self.cols + c].append(i)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _cell_range(self, bbox: BBox) -> Tuple[int, int, int, int]:
+        def clamp(v, n):
+            return min(max(int(v // self.cell_size), 0), n - 1)
+        return (clamp(bbox[0], self.cols), clamp(bbox[1], self.rows),
+                clamp(bbox[2], self.cols), clamp(bbox[3], self.rows))
+
+    def query(self, x0: float, y0: float, x1: float, y1: float, margin: float = 0.) -> List[int]:
+        """
+        Find the strokes whose bounding box, grown by margin, intersects a region.
+
+        Returns:
+            Indices of the strokes in drawing order.
+        """
+        region = (x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+        c0, r0, c1, r1 = self._cell_range(region)
+        if (c0, r0, c1, r1) == (0, 0, self.cols - 1, self.rows - 1):
+            candidates = range(len(self.bboxes))
+        else:
+            candidates = set()
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    candidates.update(self.cells[r * self.cols + c])
+        return sorted(i for i in candidates if intersects(self.bboxes[i], region))
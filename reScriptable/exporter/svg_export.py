@@ -1,8 +1,15 @@
-from typing import Iterable, Optional, Text, TextIO, Tuple, Union
+from typing import BinaryIO, Iterable, List, Optional, Text, TextIO, Tuple, Union
 
+import gzip
 import os
 import math
 from .line_reader import RMDocument, RMStroke, RMPoint, RMPage
+from .simplify import rdp, width_runs
+from .outline import stroke_outline
+from .spatial import STROKE_MARGIN, visible_region
+from .svg_writer import SVGWriter
+from .templates import TemplateLibrary
+from .. import profiling
 
 class Colors:
     YELLOW = 'rgb(255, 255, 0)'
@@ -33,7 +40,24 @@ class RMPen:
         21: 'calligraphy',
     }
 
-    def __init__(self, idx, output: TextIO, cmap):
+    VARIABLE_WIDTH_MODES = ('outline', 'runs', 'segments')
+
+    def __init__(self, idx, output: SVGWriter, cmap, simplify: Optional[float] = None, width_step: float = .5,
+                 variable_width: Text = 'outline'):
+        """
+        Args:
+            idx: Pen type, see PEN_TYPES.
+            output: Writer to draw to.
+            cmap: Map from pen kind or color index to color.
+            simplify: If set, strokes are simplified with this tolerance in pixels before drawing.
+            width_step: Widths are rounded to a multiple of this when drawing variable width strokes as 'runs'.
+            variable_width: How to draw variable width strokes (ballpoint, paint, calligraphy):
+                'outline' draws each stroke as one filled path, 'runs' as one polyline per run of
+                similar width, and 'segments' as one polyline per point.
+        """
+        if variable_width not in RMPen.VARIABLE_WIDTH_MODES:
+            raise ValueError(f"Unknown variable width mode: '{variable_width}'")
+
         try:
             self.kind = RMPen.PEN_TYPES[idx]
         except KeyError:
@@ -41,6 +65,9 @@ class RMPen:
 
         self.cmap = cmap
         self.output = output
+        self.simplify = simplify
+        self.width_step = width_step
+        self.variable_width = variable_width
 
     def draw(self, stroke: RMStroke):
         if len(stroke.points) <= 2:
@@ -61,14 +88,14 @@ class RMPen:
             width = lambda p: max_width * (p.pressure * .6 + .4)
 
             points = [(p.x, p.y, width(p), opacity, color) for p in stroke.points]
-            self.draw_combined(points)
+            self.draw_variable(points)
 
         elif self.kind == 'fineliner':
             width = [2, 3, 5][stroke_size]
             opacity = 1
 
             points = [(p.x, p.y) for p in stroke.points]
-            self.draw_single(points, color, width, opacity)
+            self.draw_single(self._simplified(points), color, width, opacity)
 
         elif self.kind == 'paint':
             # TODO texture
@@ -78,14 +105,14 @@ class RMPen:
             width = lambda p: max_width * ((p.pressure * 1) - (p.speed * .2 / 50))
 
             points = [(p.x, p.y, width(p), opacity, color) for p in stroke.points]
-            self.draw_combined(points)
+            self.draw_variable(points)
 
         elif self.kind == 'highlighter':
             width = [15, 20, 25][stroke_size]
             opacity = 0.4
 
             points = [(p.x, p.y) for p in stroke.points]
-            self.draw_single(points, color, width, opacity)
+            self.draw_single(self._simplified(points), color, width, opacity)
             # points = " ".join([f"{p.x},{p.y}" for p in stroke.points])
             # self.output.write(f'<polyline points="{points}" style="fill:none;stroke:{color};stroke-width:{width};opacity:{opacity}" />\n')
         elif self.kind == 'calligraphy':
@@ -95,13 +122,28 @@ class RMPen:
             width = lambda p: ((-math.cos(p.direction) + 1) * .9 / 2.0 + .1) * max_width
 
             points = [(p.x, p.y, width(p), opacity, color) for p in stroke.points]
-            self.draw_combined(points)
+            self.draw_variable(points)
         else:
             print(f"Unknown pen type: {self.kind}")
 
+    def _simplified(self, points):
+        return points if self.simplify is None else rdp(points, self.simplify)
+
+    def draw_variable(self, points: Iterable[Tuple[float, float, float, float, Text]]):
+        """
+        Draw a line with varying width, see draw_combined for the format of points.
+        """
+        points = self._simplified(points)
+        if self.variable_width == 'outline':
+            self.draw_outline(points)
+        elif self.variable_width == 'runs':
+            for width, run in width_runs(points, self.width_step):
+                self.draw_single(run, run[0][4], width, run[0][3])
+        else:
+            self.draw_combined(points)
+
     def draw_single(self, points: Iterable[Tuple[float, float]], color: Text, width: float, opacity: float):
-        points = " ".join([f"{round(p[0])},{round(p[1])}" for p in points])
-        self.output.write(f'<polyline points="{points}" style="fill:none;stroke:{color};stroke-width:{width};opacity:{opacity}" />\n')
+        self.output.polyline(points, f"fill:none;stroke:{color};stroke-width:{round(width, 2)};opacity:{opacity:g}")
 
     def draw_combined(self, points: Iterable[Tuple[float, float, float, float, Text]],eps: float = 1e-8):
         """
@@ -114,118 +156,164 @@ class RMPen:
             last_p = points[i]
             next_p = points[i+2]
             w = sum([last_p[2], p[2], next_p[2]]) / 3.
-            self.output.write(f'<polyline points="{round(last_p[0])},{round(last_p[1])} {round(p[0])},{round(p[1])} {round(next_p[0])},{round(next_p[1])}" style="fill:none;stroke:{p[4]};stroke-width:{w};opacity:{p[3]}" />')
-            last_p = p
-
-    def side_of_line(self, lineA, lineB, p):
-        return ((lineB[0] - lineA[0]) * (p[1] - lineA[1]) - (lineB[1] - lineA[1]) * (p[0] - lineA[0])) >= 0
-
-    def draw_combined2(self, points: Iterable[Tuple[float, float, float, float, Text]], eps: float = 1e-8, min_dist_sq: float = 2.5):
-        last_point = points[0]
-        last_p1 = None
-        last_p2 = None
+            self.draw_single((last_p, p, next_p), p[4], w, p[3])
 
-        for i, p in enumerate(points[1:-1]):
-            if (last_point[0] - p[0]) ** 2 + (last_point[1] - p[1]) ** 2 < min_dist_sq:
-                continue
-            next_point = points[i+2]
-
-            m1 = (p[1] - last_point[1]) / (p[0] - last_point[0] + eps)
-            m2 = (next_point[1] - p[1]) / (next_point[0] - p[0] + eps)
-
-            tanA = (m2 - m1) / (1 + m1 * m2 + eps)
-
-            alpha_1 = math.atan(m1)
-            alpha = math.atan(tanA)
-
-            midpoint = alpha_1 + .5 * alpha
-
-            dx = p[2] * math.cos(midpoint)
-            dy = p[2] * math.sin(midpoint)
-
-            p1 = (p[0] + dx, p[1] + dy)
-            p2 = (p[0] - dx, p[1] - dy)
-
-            if last_p1 is None:
-                last_p1 = last_point[0] + dx, last_point[1] + dy
-                last_p2 = last_point[0] - dx, last_point[1] - dy
-
-            order = [last_p1, p1, p2, last_p2]
-            nums = [1, 2, 3, 4]
-
-            if self.side_of_line(last_point, p, order[0]) != self.side_of_line(last_point, p, order[1]):
-                order[1:3] = order[1:3][::-1]
-                nums[1:3] = nums[1:3][::-1]
-
-            if self.side_of_line(last_point, p, order[1]) != self.side_of_line(last_point, p, order[2]):
-                order[2:] = order[2:][::-1]
-                nums[2:] = nums[2:][::-1]
-            # print(nums)
-
-            colors = ['red', 'green', 'blue', 'yellow', 'purple', 'orange', 'darksalmon']
-            self.output.write(f'<polygon points="')
-            self.output.write(" ".join([f'{round(c[0])},{round(c[1])}' for c in order]))
-            # self.output.write(f'" style="fill:{p[4]};stroke:none;opacity:{p[3]}" />\n')
-            self.output.write(f'" style="fill:{p[4]};stroke:{colors[i % len(colors)]};opacity:{p[3]}" />\n')
-            # for j, c in enumerate(order):
-            #     self.output.write(f'<circle cx="{round(c[0])}" cy="{round(c[1])}" r="1" fill="{colors[j]}" />\n')
-            last_p1, last_p2, last_point = p1, p2, p
-            # if i >= 1:
-            #     print(i)
-            #     return
+    def draw_outline(self, points: Iterable[Tuple[float, float, float, float, Text]]):
+        """
+        Draw a line with varying width as one filled path, see draw_combined for the format of points.
+        """
+        outline = stroke_outline(points)
+        if not outline:
+            return
+        self.output.polygon_path(outline, f"fill:{points[0][4]};stroke:none;opacity:{points[0][3]:g}")
 
 
 class RMToSVG:
-    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872):
+    COLORMAP = {
+        0: Colors.BLACK,
+        1: Colors.GRAY,
+        2: Colors.WHITE,
+        'highlighter': Colors.YELLOW,
+    }
+
+    def __init__(self, doc: RMDocument, width: int = 1404, height: int = 1872,
+                 simplify: Optional[float] = None, width_step: float = .5, variable_width: Text = 'outline',
+                 templates: Optional[TemplateLibrary] = None, embed_templates: bool = True):
+        """
+        Args:
+            doc: The document to export.
+            width, height: Page size.
+            simplify, width_step, variable_width: How strokes are drawn, see RMPen.
+            templates: If given, pages with a filled background get their template from it.
+            embed_templates: Embed templates in the SVGs, or otherwise link to their image files.
+        """
         self.doc = doc
         self.width = width
         self.height = height
+        self.simplify = simplify
+        self.width_step = width_step
+        self.variable_width = variable_width
+        self.templates = templates
+        self.embed_templates = embed_templates
+
+        self.colormap = dict(RMToSVG.COLORMAP)
+
+    def _write_page_to_textio(self, page: Optional[RMPage], output: Union[TextIO, BinaryIO], fill_bg: bool = True,
+                              region: Optional[Tuple[float, float, float, float]] = None,
+                              template: Optional[Text] = None):
+        """
+        Write one page, or an empty page if page is None, to a text or binary stream.
 
-        self.colormap = {
-            0: Colors.BLACK,
-            1: Colors.GRAY,
-            2: Colors.WHITE,
-            'highlighter': Colors.YELLOW,
-        }
+        Args:
+            region: (x0, y0, x1, y1) to write only this part of the page, in .rm pixels.
+            template: Name of the template drawn on the background, if fill_bg is set.
+        """
+        with profiling.timer('svg'):
+            if region is not None:
+                writer = SVGWriter(output, region[2] - region[0], region[3] - region[1], origin=region[:2])
+            else:
+                writer = SVGWriter(output, self.width, self.height)
+                # Strokes outside of a smaller canvas are clipped, skip them right away
+                region = visible_region(self.width, self.height)
 
-    def _write_page_to_textio(self, page: RMPage, output: TextIO, fill_bg: bool = True):
-        output.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}">\n')
+            if fill_bg:
+                writer.background()
+                if template is not None and self.templates is not None:
+                    href = self.templates.svg_href(template, self.embed_templates)
+                    if href is not None:
+                        writer.image(href, 0, 0, self.width, self.height)
 
-        if fill_bg:
-            # TODO Add support for templates
-            output.write('<rect width="100%" height="100%" fill="white" />')
+            if page is not None:
+                for _, header, data in page.iter_strokes(region):
+                    self.draw_stroke(RMStroke.from_header(header, data), writer)
 
-        for layer in page.layers:
-            for stroke in layer.strokes:
-                self.draw_stroke(stroke, output)
+            writer.close()
 
-        output.write('</svg>')
+    def write(self, out: Optional[Union[Text, Iterable[Union[TextIO, BinaryIO]]]] = None, fill_bg: bool = True,
+              pages: Optional[Iterable[int]] = None, compress: bool = False):
+        """
+        Write pages as SVG.
 
-    def write(self, out: Optional[Union[Text, Iterable[TextIO]]] = None, fill_bg: bool = True):
+        Args:
+            out: Directory to write p<n>.svg files to, or one text or binary stream per page.
+            fill_bg: Fill the background with white.
+            pages: Indices of the pages to write, defaults to all pages.
+            compress: Write gzip compressed p<n>.svgz files, if out is a directory.
+        """
         out = out if out is not None else f"{self.doc.metadata['visibleName']}.svg"
         if isinstance(out, (str, os.PathLike)):
             os.makedirs(out, exist_ok=True)
-        for i, page in enumerate(self.doc.pages):
-            if isinstance(out, str):
-                with open(os.path.join(out, f"p{i+1}.svg"), 'w+') as output:
-                    if page is None:
-                        output.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}">\n')
-                        if fill_bg:
-                            output.write('<rect width="100%" height="100%" fill="white" />')
-                        output.write('</svg>')
-                    else:
-                        self._write_page_to_textio(page, output, fill_bg)
-            else:
-                if page is None:
-                    output.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}">\n')
-                    if fill_bg:
-                        output.write('<rect width="100%" height="100%" fill="white" />')
-                    output.write('</svg>')
+        if pages is None:
+            pages = range(len(self.doc.pages))
+        for i in pages:
+            page = self.doc.pages[i]
+            if isinstance(out, (str, os.PathLike)):
+                if compress:
+                    with gzip.open(os.path.join(out, f"p{i+1}.svgz"), 'wb') as output:
+                        self._write_page_to_textio(page, output, fill_bg, template=self.doc.template(i))
                 else:
-                    self._write_page_to_textio(page, out[i], fill_bg)
+                    with open(os.path.join(out, f"p{i+1}.svg"), 'w+') as output:
+                        self._write_page_to_textio(page, output, fill_bg, template=self.doc.template(i))
+            else:
+                self._write_page_to_textio(page, out[i], fill_bg, template=self.doc.template(i))
+            if page is not None:
+                page.close()
+
+    def write_region(self, idx: int, region: Tuple[float, float, float, float],
+                     out: Union[Text, TextIO, BinaryIO], fill_bg: bool = True):
+        """
+        Write the part (x0, y0, x1, y1) of a page as SVG. Only strokes near the region are read.
+
+        Args:
+            idx: Index of the page.
+            out: Path of the SVG, or a text or binary stream.
+        """
+        page = self.doc.pages[idx]
+        try:
+            if isinstance(out, (str, os.PathLike)):
+                with open(out, 'w+') as output:
+                    self._write_page_to_textio(page, output, fill_bg, region, self.doc.template(idx))
+            else:
+                self._write_page_to_textio(page, out, fill_bg, region, self.doc.template(idx))
+        finally:
+            if page is not None:
+                page.close()
 
-    def draw_stroke(self, stroke: RMStroke, output: TextIO):
-        pen = RMPen(stroke.pen_type, output, self.colormap)
+    def write_tiles(self, idx: int, out: Text, tile_size: int = 512, fill_bg: bool = True,
+                    skip_empty: bool = True) -> List[Text]:
+        """
+        Write a page as a grid of tile_size x tile_size SVGs, named t<row>_<col>.svg.
+
+        Args:
+            skip_empty: Leave out tiles without strokes.
+
+        Returns:
+            Paths of the tiles written.
+        """
+        os.makedirs(out, exist_ok=True)
+        page = self.doc.pages[idx]
+        paths = []
+        try:
+            for row in range(math.ceil(self.height / tile_size)):
+                for col in range(math.ceil(self.width / tile_size)):
+                    region = (col * tile_size, row * tile_size,
+                              min((col + 1) * tile_size, self.width), min((row + 1) * tile_size, self.height))
+                    if page is not None:
+                        empty = not page.index.query(*region, STROKE_MARGIN)
+                    else:
+                        empty = True
+                    if empty and skip_empty:
+                        continue
+                    paths.append(os.path.join(out, f"t{row}_{col}.svg"))
+                    with open(paths[-1], 'w+') as output:
+                        self._write_page_to_textio(page, output, fill_bg, region, self.doc.template(idx))
+        finally:
+            if page is not None:
+                page.close()
+        return paths
+
+    def draw_stroke(self, stroke: RMStroke, output: SVGWriter):
+        pen = RMPen(stroke.pen_type, output, self.colormap, self.simplify, self.width_step, self.variable_width)
         pen.draw(stroke)
 
 def to_svg(path, name, out_name=None):
@@ -0,0 +1,102 @@
+from typing import BinaryIO, Dict, List, Optional, Sequence, Text, TextIO, Tuple, Union
+
+import io
+
+from xml.sax.saxutils import escape
+
+from .. import profiling
+
+
+def point_formatter(precision: int = 0):
+    """
+    Get a function formatting a sequence of points as "x,y x,y ..." with a fixed number of decimals.
+    """
+    fmt = f"{{:.{precision}f}},{{:.{precision}f}}".format
+    return lambda points: " ".join([fmt(p[0], p[1]) for p in points])
+
+
+class SVGWriter:
+    """
+    Collects the elements of one SVG page and writes it in one go when closed.
+
+    Identical style attributes are replaced by CSS classes, declared once in a <style>
+    element. The output may be a text stream, or a binary stream such as a gzip.GzipFile
+    for .svgz output.
+    """
+    def __init__(self, output: Union[TextIO, BinaryIO], width: int, height: int, precision: int = 0,
+                 origin: Optional[Tuple[float, float]] = None):
+        """
+        Args:
+            width, height: Size of the page.
+            precision: Number of decimals of coordinates.
+            origin: If given, the page shows the width x height region starting at origin,
+                instead of starting at (0, 0).
+        """
+        self.output = output
+        self.width = width
+        self.height = height
+        self.origin = origin
+
+        self.format_points = point_formatter(precision)
+        self.format_points_fine = point_formatter(precision + 1)
+
+        self.styles: Dict[Text, Text] = {}
+        self.parts: List[Text] = []
+
+    def style_class(self, style: Text) -> Text:
+        if style not in self.styles:
+            self.styles[style] = f"s{len(self.styles)}"
+        return self.styles[style]
+
+    def raw(self, element: Text):
+        self.parts.append(element)
+
+    def background(self, fill: Text = 'white'):
+        x, y = self.origin if self.origin is not None else (0, 0)
+        if x or y:
+            self.parts.append(f'<rect x="{x}" y="{y}" width="100%" height="100%" fill="{fill}"/>\n')
+        else:
+            self.parts.append(f'<rect width="100%" height="100%" fill="{fill}"/>\n')
+
+    def image(self, href: Text, x: float, y: float, width: float, height: float):
+        """
+        Draw an image, stretched to the given rectangle.
+
+        Args:
+            href: URI of the image, e.g. a data: or file: URI.
+        """
+        # xlink:href rather than href, for inkscape before 1.0
+        href = escape(href, {'"': '&quot;'})
+        self.parts.append(f'<image x="{x}" y="{y}" width="{width}" height="{height}" '
+                          f'preserveAspectRatio="none" xlink:href="{href}"/>\n')
+
+    def polyline(self, points: Sequence[Tuple[float, float]], style: Text):
+        self.parts.append(f'<polyline class="{self.style_class(style)}" points="{self.format_points(points)}"/>\n')
+
+    def polygon_path(self, points: Sequence[Tuple[float, float]], style: Text):
+        """
+        Write a closed, filled path. Coordinates get one more decimal than polylines, since
+        outlines of thin strokes are only a pixel or two wide.
+        """
+        self.parts.append(f'<path class="{self.style_class(style)}" d="M{self.format_points_fine(points)} Z"/>\n')
+
+    def getvalue(self) -> Text:
+        if self.origin is not None:
+            view_box = f' viewBox="{self.origin[0]} {self.origin[1]} {self.width} {self.height}"'
+        else:
+            view_box = ''
+        header = (f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                  f'width="{self.width}" height="{self.height}"{view_box}>\n')
+        if self.styles:
+            css = "\n".join(f".{name}{{{style}}}" for style, name in self.styles.items())
+            header += f'<style>\n{css}\n</style>\n'
+        return header + "".join(self.parts) + '</svg>\n'
+
+    def close(self):
+        data = self.getvalue()
+        profiling.count('svg_bytes', len(data))
+        if isinstance(self.output, (io.RawIOBase, io.BufferedIOBase)):
+            self.output.write(data.encode('utf-8'))
+        else:
+            self.output.write(data)
+        self.parts = []
@@ -0,0 +1,164 @@
+from typing import Dict, Iterable, Optional, Text
+
+import base64
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+from pathlib import Path
+
+from .page_cache import PageCache
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# The templates shipped with reScriptable
+DEFAULT_TEMPLATE_DIRS = [os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                      'templates')]
+
+BLANK = 'Blank'
+
+# Prepared backgrounds, shared by all libraries in a process, keyed by (template hash, kind, width, height)
+_prepared: Dict[tuple, object] = {}
+_hashes: Dict[tuple, Text] = {}
+
+
+class TemplateLibrary:
+    """
+    Finds tablet templates by the name used in .pagedata, and prepares them as page backgrounds.
+
+    A template is either a <name>.png in one of the directories, as in /usr/share/remarkable/templates
+    on the tablet, or a folder with a meta.json whose "filename" is the name, as in templates/.
+
+    Prepared backgrounds (scaled and flattened pixels for PDF and PNG output, base64 for SVG) are
+    kept in memory for the whole process, and in cache_dir if given, so that thousands of pages
+    sharing a few templates only prepare each once.
+    """
+    def __init__(self, dirs: Optional[Iterable[os.PathLike]] = None, cache_dir: Optional[os.PathLike] = None):
+        self.dirs = list(dirs) if dirs is not None else DEFAULT_TEMPLATE_DIRS
+        self.cache_dir = cache_dir
+        self._paths: Optional[Dict[Text, Text]] = None
+        self._missing = set()
+
+    def _scan(self):
+        self._paths = {}
+        for d in self.dirs:
+            if not os.path.isdir(d):
+                continue
+            for entry in sorted(os.listdir(d)):
+                path = os.path.join(d, entry)
+                if entry.endswith('.png'):
+                    self._paths.setdefault(entry[:-len('.png')], path)
+                elif os.path.exists(os.path.join(path, 'meta.json')):
+                    with open(os.path.join(path, 'meta.json')) as f:
+                        name = json.loads(f.read())['filename']
+                    if os.path.exists(os.path.join(path, f"{name}.png")):
+                        self._paths.setdefault(name, os.path.join(path, f"{name}.png"))
+
+    def path(self, name: Optional[Text]) -> Optional[Text]:
+        """
+        Path of the image of a template, or None for blank pages and templates that are not found.
+        """
+        if not name or name == BLANK:
+            return None
+        if self._paths is None:
+            self._scan()
+        path = self._paths.get(name)
+        if path is None and name not in self._missing:
+            self._missing.add(name)
+            print(f"Warning: template '{name}' not found, leaving the background blank", file=sys.stderr)
+        return path
+
+    def key(self, name: Optional[Text]) -> Optional[Text]:
+        """
+        Hash of the image of a template, identifying it in caches. None if there is no image.
+        """
+        path = self.path(name)
+        if path is None:
+            return None
+        st = os.stat(path)
+        stat_key = (path, st.st_size, st.st_mtime_ns)
+        if stat_key not in _hashes:
+            with open(path, 'rb') as f:
+                _hashes[stat_key] = hashlib.sha256(f.read()).hexdigest()
+        return _hashes[stat_key]
+
+    def svg_href(self, name: Optional[Text], embed: bool = True) -> Optional[Text]:
+        """
+        Reference to a template for an SVG <image>, which scales it to the page itself.
+
+        Args:
+            embed: Return the image as a data URI. Otherwise return a file: URI of the image, which
+                keeps SVGs small when they are only read on this machine, e.g. by inkscape.
+        """
+        path = self.path(name)
+        if path is None:
+            return None
+        if not embed:
+            return Path(path).resolve().as_uri()
+        key = (self.key(name), 'svg', 0, 0)
+        if key not in _prepared:
+            with open(path, 'rb') as f:
+                _prepared[key] = 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+        return _prepared[key]
+
+    def image(self, name: Optional[Text], width: int, height: int) -> Optional['Image.Image']:
+        """
+        A template scaled to width x height and flattened onto white, as an RGB image.
+        """
+        return self._prepare(name, 'png', width, height, '.png',
+                             lambda gray: gray.convert('RGB'),
+                             lambda image, path: image.save(path, 'PNG'),
+                             lambda path: Image.open(path).convert('RGB'))
+
+    def pdf_image(self, name: Optional[Text], width: int, height: int) -> Optional[bytes]:
+        """
+        A template scaled to width x height and flattened onto white, as zlib compressed
+        8 bit gray pixels, ready for a PDF image XObject with /FlateDecode.
+        """
+        def save(data, path):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+        def load(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        return self._prepare(name, 'pdf', width, height, '.flate',
+                             lambda gray: zlib.compress(gray.tobytes()), save, load)
+
+    def _prepare(self, name, kind, width, height, suffix, convert, save, load):
+        template_key = self.key(name)
+        if template_key is None:
+            return None
+        key = (template_key, kind, width, height)
+        if key in _prepared:
+            return _prepared[key]
+
+        if Image is None:
+            print("Warning: Pillow is required to draw templates in PDF and PNG output", file=sys.stderr)
+            _prepared[key] = None
+            return None
+
+        cache = PageCache(self.cache_dir, suffix=suffix) if self.cache_dir is not None else None
+        cache_key = PageCache.key(None, template=template_key, kind=kind, width=width, height=height)
+        cache_path = cache.get(cache_key) if cache is not None else None
+        if cache_path is not None:
+            _prepared[key] = load(cache_path)
+            return _prepared[key]
+
+        with Image.open(self.path(name)) as source:
+            rgba = source.convert('RGBA').resize((width, height), Image.LANCZOS)
+        gray = Image.new('L', (width, height), 255)
+        gray.paste(rgba.convert('L'), mask=rgba.getchannel('A'))
+        _prepared[key] = convert(gray)
+
+        if cache is not None:
+            tmp_path = cache.path(cache_key) + f'.{os.getpid()}.tmp'
+            save(_prepared[key], tmp_path)
+            os.replace(tmp_path, cache.path(cache_key))
+        return _prepared[key]
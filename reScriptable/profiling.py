@@ -0,0 +1,89 @@
+# Timers and counters for the sync and export pipeline.
+#
+# Everything is a no-op until enable() is called, so the instrumentation can stay in place.
+# Hot loops check profiling.enabled themselves before calling into this module.
+from typing import Dict, Optional
+
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+enabled = False
+
+_lock = threading.Lock()
+_timers: Dict[str, list] = {}
+_counters: Dict[str, int] = {}
+
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+
+def add_time(name: str, seconds: float, calls: int = 1):
+    with _lock:
+        entry = _timers.setdefault(name, [0., 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+
+def count(name: str, n: int = 1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(name: str):
+    """
+    Add the time spent in the with block to the timer name.
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def collect(reset: bool = True) -> dict:
+    """
+    Get the current timers and counters, and by default reset them.
+    """
+    with _lock:
+        data = {
+            'timers': {name: {'seconds': s, 'calls': c} for name, (s, c) in _timers.items()},
+            'counters': dict(_counters),
+        }
+        if reset:
+            _timers.clear()
+            _counters.clear()
+    return data
+
+
+def merge(data: Optional[dict]):
+    """
+    Add the timers and counters collected in another process.
+    """
+    if not data:
+        return
+    for name, timer_data in data['timers'].items():
+        add_time(name, timer_data['seconds'], timer_data['calls'])
+    with _lock:
+        for name, n in data['counters'].items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def write_report(path: str, **extra):
+    """
+    Write the collected timers and counters, and anything in extra, as JSON.
+    """
+    report = collect(reset=False)
+    report.update(extra)
+    with open(path, 'w+') as f:
+        json.dump(report, f, indent=2)
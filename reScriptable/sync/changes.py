@@ -0,0 +1,109 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import json
+import os
+
+# Generated on the tablet from the pages, and not used by the export
+IGNORED_SUFFIXES = ('.thumbnails', '.textconversion')
+
+
+class ChangeSet:
+    """
+    Differences between two snapshots of a xochitl directory, as sets of uuids.
+
+    modified holds files whose content (pages, pdf, ...) changed, moved holds files whose
+    name or parent folder changed. A file can be in both.
+    """
+    def __init__(self, added: Iterable[str] = (), modified: Iterable[str] = (), deleted: Iterable[str] = (),
+                 moved: Iterable[str] = ()):
+        self.added: Set[str] = set(added)
+        self.modified: Set[str] = set(modified)
+        self.deleted: Set[str] = set(deleted)
+        self.moved: Set[str] = set(moved)
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.deleted or self.moved)
+
+    def __repr__(self):
+        return (f"ChangeSet(added={len(self.added)}, modified={len(self.modified)}, "
+                f"deleted={len(self.deleted)}, moved={len(self.moved)})")
+
+    def to_json(self):
+        return {key: sorted(getattr(self, key)) for key in ('added', 'modified', 'deleted', 'moved')}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['added'], data['modified'], data['deleted'], data['moved'])
+
+    def save(self, path: os.PathLike):
+        with open(path, 'w+') as f:
+            json.dump(self.to_json(), f)
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> 'ChangeSet':
+        with open(path) as f:
+            return cls.from_json(json.loads(f.read()))
+
+
+def _file_signatures(xochitl: os.PathLike) -> Dict[str, Dict[str, Tuple[int, int]]]:
+    """
+    Collect (inode, size) of every file in a xochitl directory, grouped by the uuid it belongs to.
+
+    Files belong to the uuid before the first '.' of their top level entry, e.g.
+    <uuid>.metadata, <uuid>.content and everything under <uuid>/ or <uuid>.thumbnails/.
+    """
+    signatures = {}
+    for entry in os.scandir(xochitl):
+        if entry.name.endswith(IGNORED_SUFFIXES):
+            continue
+        uuid = entry.name.split('.', 1)[0]
+        files = signatures.setdefault(uuid, {})
+        if entry.is_dir(follow_symlinks=False):
+            for root, _, names in os.walk(entry.path):
+                for name in names:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path, follow_symlinks=False)
+                    files[os.path.relpath(path, xochitl)] = (stat.st_ino, stat.st_size)
+        else:
+            stat = entry.stat(follow_symlinks=False)
+            files[entry.name] = (stat.st_ino, stat.st_size)
+    return signatures
+
+
+def _placement(xochitl: os.PathLike, uuid: str) -> Optional[Tuple[str, str]]:
+    try:
+        with open(os.path.join(xochitl, f"{uuid}.metadata")) as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    return data.get('visibleName'), data.get('parent') or ''
+
+
+def diff_snapshots(old: os.PathLike, new: os.PathLike) -> ChangeSet:
+    """
+    Compare two snapshots of a xochitl directory.
+
+    The new snapshot is expected to be made with rsync --link-dest pointing at the old one,
+    so unchanged files are hard links and share their inode. Only metadata files that
+    changed are parsed, to tell moves and renames apart from other metadata changes.
+    """
+    old_files = _file_signatures(old)
+    new_files = _file_signatures(new)
+
+    changes = ChangeSet(
+        added=(uuid for uuid in new_files if uuid not in old_files),
+        deleted=(uuid for uuid in old_files if uuid not in new_files),
+    )
+
+    for uuid, files in new_files.items():
+        old_sig = old_files.get(uuid)
+        if old_sig is None or old_sig == files:
+            continue
+
+        metadata = f"{uuid}.metadata"
+        if {k: v for k, v in files.items() if k != metadata} != {k: v for k, v in old_sig.items() if k != metadata}:
+            changes.modified.add(uuid)
+        if files.get(metadata) != old_sig.get(metadata) and _placement(old, uuid) != _placement(new, uuid):
+            changes.moved.add(uuid)
+
+    return changes
@@ -0,0 +1,31 @@
+from typing import Iterable, Optional
+
+import json
+import os
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+
+def load_config(path: Optional[os.PathLike] = DEFAULT_CONFIG_PATH, required: Iterable[str] = (), **overrides) -> dict:
+    """
+    Read the JSON config file, with its values replaced by the overrides that are not None.
+
+    Args:
+        path: The config file. It may be missing if the overrides give everything that is required.
+        required: Keys that must be set, in the file or by the overrides.
+        overrides: Values given some other way, typically on the command line.
+
+    Returns:
+        The config as a dict.
+    """
+    conf = {}
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            conf = json.loads(f.read())
+    conf.update((key, value) for key, value in overrides.items() if value is not None)
+
+    missing = [key for key in required if conf.get(key) is None]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}: set in neither the config file {path} "
+                         "nor the command line args")
+    return conf
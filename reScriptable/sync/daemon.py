@@ -0,0 +1,130 @@
+import datetime
+import os
+import sys
+import time
+
+from typing import Optional
+
+from .sync import sync
+from .changes import ChangeSet, diff_snapshots
+from .metadata_index import MetadataIndex
+from .rm_to_dir import RMDirectory, write_json_atomic
+
+
+class SyncDaemon:
+    """
+    Keeps the nice directory up to date, syncing and exporting every interval seconds.
+
+    The RMDirectory is kept between runs and only updated with the changes of each new
+    snapshot, and only changed documents are exported. Documents that failed to export
+    are retried on the next run, even if nothing changed. If the tablet cannot be reached,
+    the wait between attempts doubles up to max_backoff. The current state, the number
+    of documents waiting to be exported and the duration of the last run are written to
+    status_path as JSON.
+    """
+    def __init__(self, host, remote_dir, local_raw, local_nice, interval: float = 300, max_backoff: float = 3600,
+                 status_path: Optional[str] = None, do_sync: bool = True, jobs: int = 1,
+                 index: Optional[MetadataIndex] = None, **export_args):
+        """
+        Args:
+            do_sync: If False, do not contact the tablet, but export whenever the latest
+                snapshot in local_raw changes, e.g. when synced by another process.
+            export_args: Passed on to to_readable.
+        """
+        self.host = host
+        self.remote_dir = remote_dir
+        self.local_raw = local_raw
+        self.local_nice = local_nice
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.status_path = status_path if status_path is not None else os.path.join(local_raw, 'daemon_status.json')
+        os.makedirs(os.path.dirname(os.path.abspath(self.status_path)), exist_ok=True)
+        self.do_sync = do_sync
+        self.jobs = jobs
+        self.index = index
+        self.export_args = export_args
+
+        xochitl = os.path.basename(remote_dir.rstrip('/')) if remote_dir is not None else 'xochitl'
+        self.rm_path = os.path.join(local_raw, 'latest', xochitl)
+        self.direc: Optional[RMDirectory] = None
+        self.snapshot = None
+        self.failed = {}
+
+        self.status = {
+            'state': 'starting',
+            'queue_depth': 0,
+            'runs': 0,
+            'failed_documents': 0,
+            'last_run': None,
+            'last_sync_seconds': None,
+            'last_export_seconds': None,
+            'last_error': None,
+            'next_run': None,
+        }
+
+    def _set_status(self, **kwargs):
+        self.status.update(kwargs)
+        write_json_atomic(self.status_path, self.status)
+
+    def _sync(self):
+        """
+        Get a new snapshot.
+
+        Returns:
+            The changes since the last run, empty if there is no new snapshot, or None if they are not known.
+        """
+        if self.do_sync:
+            return sync(self.host, self.remote_dir, self.local_raw)
+
+        snapshot = os.path.realpath(self.rm_path)
+        if snapshot == self.snapshot:
+            return ChangeSet()
+        # Other processes may have made several snapshots since the last run, so compare
+        # with the one seen last instead of using the changes.json of the newest
+        previous, self.snapshot = self.snapshot, snapshot
+        if previous is None or not os.path.isdir(previous):
+            return None
+        return diff_snapshots(previous, snapshot)
+
+    def run_once(self):
+        start = time.perf_counter()
+        self._set_status(state='syncing')
+        changes = self._sync()
+        sync_time = time.perf_counter() - start
+
+        if changes is None or changes or self.direc is None or self.failed:
+            if self.direc is None or changes is None:
+                self.direc = RMDirectory(self.rm_path, self.index)
+            elif changes:
+                self.direc.update(changes)
+
+            if changes is not None:
+                queue_depth = len(changes.added | changes.modified | set(self.failed))
+            else:
+                queue_depth = len(self.direc.rmfiles)
+            self._set_status(state='exporting', queue_depth=queue_depth)
+            start = time.perf_counter()
+            self.failed = self.direc.to_readable(self.local_nice, jobs=self.jobs, changes=changes, **self.export_args)
+            self._set_status(failed_documents=len(self.failed), last_export_seconds=time.perf_counter() - start)
+
+        self._set_status(state='idle', queue_depth=0, runs=self.status['runs'] + 1, last_sync_seconds=sync_time,
+                         last_run=datetime.datetime.now().isoformat(), last_error=None)
+
+    def run(self):
+        backoff = self.interval
+        while True:
+            try:
+                self.run_once()
+                wait = backoff = self.interval
+                state = 'idle'
+            except OSError as e:
+                # rsync fails when the tablet is not reachable
+                print(f"Sync failed: {e}", file=sys.stderr)
+                wait = backoff
+                backoff = min(backoff * 2, self.max_backoff)
+                state = 'backoff'
+                self.status['last_error'] = str(e)
+
+            next_run = datetime.datetime.now() + datetime.timedelta(seconds=wait)
+            self._set_status(state=state, next_run=next_run.isoformat())
+            time.sleep(wait)
@@ -1,18 +1,18 @@
 from .sync import sync
-from .rm_to_dir import RMDirectory
-import json
+from .rm_to_dir import RMDirectory, is_up_to_date
+from .metadata_index import MetadataIndex
+from .config import DEFAULT_CONFIG_PATH, load_config
 import os
 import sys
 
 if __name__ == "__main__":
-    conf_path = os.path.join(os.path.dirname(__file__), 'config.json')
-    if len(sys.argv) > 1:
-        conf_path = sys.argv[1]
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CONFIG_PATH,
+                         ['host', 'remote_dir', 'local_raw', 'local_nice'])
 
-    with open(conf_path) as f:
-        config = json.loads(f.read())
+    changes = sync(config['host'], config['remote_dir'], config['local_raw'])
 
-    sync(config['host'], config['remote_dir'], config['local_raw'])
-
-    direc = RMDirectory(os.path.join(config['local_raw'], 'latest', 'xochitl'))
-    direc.to_readable(config['local_nice'])
+    xochitl = os.path.join(config['local_raw'], 'latest', 'xochitl')
+    if not is_up_to_date(xochitl, config['local_nice'], changes):
+        index = MetadataIndex(os.path.join(config['local_raw'], 'metadata_index.sqlite'))
+        direc = RMDirectory(xochitl, index)
+        direc.to_readable(config['local_nice'], jobs=config.get('jobs', 1), changes=changes)
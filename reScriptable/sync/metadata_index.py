@@ -0,0 +1,134 @@
+from typing import Dict, List, Optional
+
+import argparse
+import json
+import os
+import sqlite3
+
+
+class MetadataIndex:
+    """
+    SQLite index of the .metadata files of a xochitl directory.
+
+    Each file is stored with the inode, mtime and size it had when it was read, so `load`
+    only has to parse files that changed since the last time. Snapshots made with
+    rsync --link-dest hard-link unchanged files, so the index stays valid across snapshots.
+    The index can also be queried on its own with `find`, without reading the snapshot.
+    """
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Used from the pipeline's worker thread, but never from two threads at once
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                uuid TEXT PRIMARY KEY,
+                inode INTEGER,
+                mtime_ns INTEGER,
+                size INTEGER,
+                name TEXT,
+                type TEXT,
+                parent TEXT,
+                last_modified TEXT,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_name ON files (name);
+            CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+            CREATE INDEX IF NOT EXISTS files_type ON files (type);
+            CREATE INDEX IF NOT EXISTS files_last_modified ON files (last_modified);
+        """)
+
+    def load(self, rm_path: os.PathLike) -> Dict[str, dict]:
+        """
+        Bring the index up to date with rm_path.
+
+        Returns:
+            visibleName, type, parent and lastModified from the metadata of every file in rm_path, by uuid.
+            The full metadata is kept in the data column of the index.
+        """
+        known = {row['uuid']: row for row in self.db.execute(
+            'SELECT uuid, inode, mtime_ns, size, name, type, parent, last_modified FROM files')}
+
+        result = {}
+        changed = []
+        for entry in os.scandir(rm_path):
+            if not entry.name.endswith('.metadata'):
+                continue
+            uuid = entry.name[:-len('.metadata')]
+            stat = entry.stat()
+            row = known.get(uuid)
+            if row is not None and (row['inode'], row['mtime_ns'], row['size']) == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                result[uuid] = {
+                    'visibleName': row['name'],
+                    'type': row['type'],
+                    'parent': row['parent'] or '',
+                    'lastModified': row['last_modified'],
+                }
+                continue
+
+            with open(entry.path) as f:
+                raw = f.read()
+            data = json.loads(raw)
+            result[uuid] = {key: data.get(key) for key in ('visibleName', 'type', 'parent', 'lastModified')}
+            changed.append((uuid, stat.st_ino, stat.st_mtime_ns, stat.st_size, data.get('visibleName'), data.get('type'),
+                            data.get('parent') or None, data.get('lastModified'), raw))
+
+        removed = [(uuid,) for uuid in known if uuid not in result]
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', changed)
+            self.db.executemany('DELETE FROM files WHERE uuid = ?', removed)
+
+        return result
+
+    def find(self, name: Optional[str] = None, parent: Optional[str] = None, type: Optional[str] = None,
+             modified_since: Optional[str] = None) -> List[dict]:
+        """
+        Query the index. All given conditions must hold.
+
+        Args:
+            name: SQL LIKE pattern for the visible name.
+            parent: uuid of the parent folder, '' for the top level.
+            type: File type, see RMFileTypes.
+            modified_since: Only files with lastModified at or after this (milliseconds since the epoch, as in the metadata).
+
+        Returns:
+            uuid, name, type, parent and last_modified of every match.
+        """
+        conditions, params = [], []
+        if name is not None:
+            conditions.append('name LIKE ?')
+            params.append(name)
+        if parent is not None:
+            conditions.append('parent IS ?' if parent == '' else 'parent = ?')
+            params.append(parent or None)
+        if type is not None:
+            conditions.append('type = ?')
+            params.append(type)
+        if modified_since is not None:
+            conditions.append('CAST(last_modified AS INTEGER) >= ?')
+            params.append(int(modified_since))
+
+        query = 'SELECT uuid, name, type, parent, last_modified FROM files'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [dict(row) for row in self.db.execute(query + ' ORDER BY name', params)]
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query a metadata index")
+    parser.add_argument('index', help="Path to the index")
+    parser.add_argument('-n', '--name', help="Visible name, SQL LIKE pattern")
+    parser.add_argument('-p', '--parent', help="uuid of the parent folder, '' for the top level")
+    parser.add_argument('-t', '--type', help="File type, e.g. DocumentType or CollectionType")
+    parser.add_argument('-m', '--modified-since', help="Only files modified at or after this (ms since the epoch)")
+    args = parser.parse_args()
+
+    index = MetadataIndex(args.index)
+    for row in index.find(args.name, args.parent, args.type, args.modified_since):
+        print(f"{row['uuid']}\t{row['type']}\t{row['last_modified']}\t{row['name']}")
+    index.close()
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from .sync import new_snapshot, rsync_command, finish_snapshot
+from .rm_to_dir import RMDirectory, RMFileTypes, evict_caches, export_document, page_jobs, write_json_atomic
+from .changes import ChangeSet
+from .. import profiling
+
+
+async def _run_rsync(cmd, on_path=None):
+    """
+    Run rsync, calling on_path with every transferred path it reports.
+
+    on_path must not block: rsync is run with --timeout, so it gives up if its output is
+    not read for a while.
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+    async for line in proc.stdout:
+        if on_path is not None:
+            on_path(line.decode(errors='replace').rstrip('\n'))
+    if await proc.wait() != 0:
+        raise OSError(f"Sync returned code: {proc.returncode}")
+
+
+class TransferTracker:
+    """
+    Finds the uuids whose files are all in place, from the paths rsync --no-inc-recursive
+    --out-format=%n reports while it transfers a xochitl directory.
+
+    rsync sends the file list sorted as follows: first every file directly in the xochitl
+    directory (.content, .pagedata, .pdf, ...), then every subdirectory with its contents, in
+    the order of their names followed by a '/'. So <uuid>.thumbnails/ comes before <uuid>/.
+    A uuid is complete once rsync reports a path in a directory sorting after its <uuid>/.
+
+    Files hard linked from the previous snapshot are not reported, and directories are
+    reported for every new snapshot, so only uuids with a reported file are returned.
+    """
+    def __init__(self, xochitl: str):
+        self.prefix = f'{xochitl}/'
+        self.pending = set()
+
+    def feed(self, path: str) -> List[str]:
+        """
+        Take the next path reported by rsync.
+
+        Returns:
+            The uuids that are complete now, sorted.
+        """
+        if not path.startswith(self.prefix):
+            return []
+        name = path[len(self.prefix):]
+        if not name:
+            return []
+        top, _, rest = name.partition('/')
+        is_dir = name.endswith('/')
+        if not is_dir:
+            self.pending.add(top.split('.', 1)[0])
+        if not rest and not is_dir:
+            # A file directly in xochitl, these all come before any directory
+            return []
+
+        # rsync has reached the directory top, so everything sorting before it is complete
+        done = sorted(uuid for uuid in self.pending if uuid + '/' < top + '/')
+        self.pending.difference_update(done)
+        return done
+
+    def finish(self) -> List[str]:
+        """
+        The uuids that were not complete yet when rsync finished, sorted.
+        """
+        done = sorted(self.pending)
+        self.pending.clear()
+        return done
+
+
+async def sync_and_export(host, remote_dir, local_raw, local_nice, jobs=1, index=None, **export_args):
+    """
+    Sync with the tablet and export documents at the same time.
+
+    The stages run as follows:
+
+    1. Only the .metadata files are synced, and parsed into an RMDirectory.
+       Outputs of documents that were renamed, moved or deleted are moved or removed.
+    2. Everything else is synced. rsync is run with --no-inc-recursive, and every uuid is
+       queued for export once all of its files are in place, see TransferTracker.
+    3. Up to jobs documents are exported at a time in worker processes while rsync continues.
+       The queue is unbounded, so rsync is never held up by the exports, which would make
+       it time out.
+
+    Finally the snapshot is marked as latest, and to_readable is run with the resulting change
+    set, to move or remove outputs and export anything that was not exported above.
+
+    Args:
+        index: MetadataIndex to read metadata through, if any.
+        export_args: Passed on to export_document and to_readable (backend, cache_dir, cache_size,
+            decoded_cache_dir, template_dirs, template_cache_dir).
+
+    Returns:
+        The failures reported by to_readable. Documents that fail during the sync are retried there.
+    """
+    loop = asyncio.get_running_loop()
+    backup_path, latest_link = new_snapshot(local_raw)
+    try:
+        exported = await _sync_and_export(host, remote_dir, local_nice, backup_path, latest_link, jobs, index,
+                                          export_args)
+    except BaseException:
+        # Like sync, leave no partial snapshot behind
+        shutil.rmtree(backup_path, ignore_errors=True)
+        raise
+
+    if exported:
+        evict_caches(export_args.get('cache_dir'), export_args.get('cache_size', 512 * 1024 * 1024),
+                     export_args.get('decoded_cache_dir'))
+
+    changes = finish_snapshot(remote_dir, backup_path, latest_link)
+    if changes is not None:
+        changes = ChangeSet(changes.added - exported, changes.modified - exported, changes.deleted, changes.moved)
+
+    # The metadata is already in place, but read it again in case it changed during the sync
+    rm_path = os.path.join(backup_path, os.path.basename(remote_dir.rstrip('/')))
+    direc = await loop.run_in_executor(None, RMDirectory, rm_path, index)
+    return await loop.run_in_executor(None, lambda: direc.to_readable(
+        local_nice, jobs=jobs, changes=changes, **export_args))
+
+
+async def _sync_and_export(host, remote_dir, local_nice, backup_path, latest_link, jobs, index, export_args):
+    """
+    Stages 1 to 3 of sync_and_export.
+
+    Returns:
+        The uuids of the documents exported.
+    """
+    loop = asyncio.get_running_loop()
+    xochitl = os.path.basename(remote_dir.rstrip('/'))
+    rm_path = os.path.join(backup_path, xochitl)
+
+    # Stage 1: metadata
+    with profiling.timer('rsync_metadata'):
+        await _run_rsync(rsync_command(host, remote_dir, backup_path, latest_link,
+                                       ['--include', f'/{xochitl}/', '--include', '*.metadata', '--exclude', '*']))
+    direc = await loop.run_in_executor(None, RMDirectory, rm_path, index)
+
+    os.makedirs(local_nice, exist_ok=True)
+    last_modified_path = os.path.join(local_nice, 'last_modified.json')
+    if os.path.exists(last_modified_path):
+        with open(last_modified_path) as f:
+            last_modified = json.loads(f.read())
+    else:
+        last_modified = {}
+    paths = {}
+    direc._find_stale(local_nice, direc.structure, dict(last_modified), paths)
+
+    # Move outputs now, or they would be moved over the documents exported below
+    exported_path = os.path.join(local_nice, 'exported.json')
+    if os.path.exists(exported_path):
+        with open(exported_path) as f:
+            previous_paths = json.loads(f.read())
+    else:
+        previous_paths = {}
+    for uuid in direc._move_outputs(local_nice, previous_paths, paths):
+        last_modified.pop(uuid, None)
+    write_json_atomic(exported_path, {uuid: os.path.relpath(path, local_nice) for uuid, path in paths.items()
+                                      if os.path.exists(path)})
+
+    # Stages 2 and 3: transfer and export
+    queue = asyncio.Queue()
+    exported = set()
+    tracker = TransferTracker(xochitl)
+
+    def on_path(path):
+        for uuid in tracker.feed(path):
+            queue.put_nowait(uuid)
+
+    async def export_worker(executor):
+        while True:
+            uuid = await queue.get()
+            if uuid is None:
+                return
+            f = direc.rmfiles.get(uuid)
+            if f is None or f.type != RMFileTypes.DOCUMENT or uuid not in paths:
+                continue
+            try:
+                profiling.merge(await loop.run_in_executor(
+                    executor, export_document, rm_path, uuid, paths[uuid],
+                    export_args.get('backend', 'inkscape'), export_args.get('cache_dir'),
+                    export_args.get('cache_size', 512 * 1024 * 1024), profiling.enabled,
+                    export_args.get('decoded_cache_dir'), export_args.get('template_dirs'),
+                    export_args.get('template_cache_dir'), page_jobs(jobs)))
+            except Exception as e:
+                print(f"Failed to export '{f.name}' ({uuid}), retrying after the sync: {e}", file=sys.stderr)
+                last_modified.pop(uuid, None)
+            else:
+                last_modified[uuid] = f.last_modified
+                exported.add(uuid)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        workers = [asyncio.ensure_future(export_worker(executor)) for _ in range(jobs)]
+        try:
+            with profiling.timer('rsync'):
+                await _run_rsync(rsync_command(host, remote_dir, backup_path, latest_link,
+                                               ['--no-inc-recursive', '--out-format=%n']), on_path)
+            for uuid in tracker.finish():
+                queue.put_nowait(uuid)
+        finally:
+            for _ in workers:
+                queue.put_nowait(None)
+            await asyncio.gather(*workers)
+
+    write_json_atomic(last_modified_path, last_modified)
+    return exported
+
+
+def run_pipeline(*args, **kwargs):
+    return asyncio.run(sync_and_export(*args, **kwargs))
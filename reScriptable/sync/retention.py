@@ -0,0 +1,179 @@
+from typing import Dict, Iterable, List, Set, Tuple
+
+import argparse
+import datetime
+import filecmp
+import os
+import shutil
+
+
+def list_snapshots(local_raw: os.PathLike) -> List[Tuple[datetime.datetime, str]]:
+    """
+    Find the snapshots made by sync in local_raw.
+
+    Returns:
+        (time, path) of every snapshot, newest first.
+    """
+    snapshots = []
+    for entry in os.scandir(local_raw):
+        if entry.is_symlink() or not entry.is_dir():
+            continue
+        try:
+            time = datetime.datetime.fromisoformat(entry.name)
+        except ValueError:
+            continue
+        snapshots.append((time, entry.path))
+    return sorted(snapshots, reverse=True)
+
+
+PERIODS = {
+    'hourly': lambda t: (t.year, t.month, t.day, t.hour),
+    'daily': lambda t: (t.year, t.month, t.day),
+    'weekly': lambda t: t.isocalendar()[:2],
+    'monthly': lambda t: (t.year, t.month),
+}
+
+
+def select_snapshots(snapshots: List[Tuple[datetime.datetime, str]], **keep: int) -> Set[str]:
+    """
+    Choose which snapshots to keep, grandfather-father-son style.
+
+    For every period in PERIODS given in keep, e.g. hourly=24, the newest snapshot of each
+    of the last keep[period] periods that have snapshots is kept.
+
+    Args:
+        snapshots: As returned by list_snapshots, newest first.
+
+    Returns:
+        Paths of the snapshots to keep.
+    """
+    kept = set()
+    for period, count in keep.items():
+        bucket_of = PERIODS[period]
+        buckets = set()
+        for time, path in snapshots:
+            if len(buckets) >= count:
+                break
+            bucket = bucket_of(time)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                kept.add(path)
+    return kept
+
+
+def _usage(paths: Iterable[str]) -> Tuple[int, int]:
+    """
+    Count the inodes and bytes that would be freed by deleting all of paths.
+
+    Files are hard-linked between snapshots, so a file only frees space if all of its
+    links are within paths.
+    """
+    links: Dict[Tuple[int, int], List] = {}
+    n_dirs = 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            n_dirs += len(dirs) + (root == path)
+            for name in files:
+                stat = os.lstat(os.path.join(root, name))
+                entry = links.setdefault((stat.st_dev, stat.st_ino), [stat.st_nlink, stat.st_size, 0])
+                entry[2] += 1
+
+    freed = [size for nlink, size, count in links.values() if count >= nlink]
+    return n_dirs + len(freed), sum(freed)
+
+
+def prune(local_raw: os.PathLike, hourly: int = 24, daily: int = 7, weekly: int = 4, monthly: int = 12,
+          dry_run: bool = False) -> dict:
+    """
+    Delete the snapshots in local_raw that are not selected by select_snapshots.
+
+    The snapshot that local_raw/latest points to is always kept.
+
+    Returns:
+        Report with the kept and removed snapshot paths, and the inodes and bytes reclaimed.
+    """
+    snapshots = list_snapshots(local_raw)
+    keep = select_snapshots(snapshots, hourly=hourly, daily=daily, weekly=weekly, monthly=monthly)
+
+    latest = os.path.join(local_raw, 'latest')
+    if os.path.exists(latest):
+        keep.add(os.path.join(local_raw, os.path.basename(os.path.realpath(latest))))
+
+    remove = [path for _, path in snapshots if path not in keep]
+    inodes, n_bytes = _usage(remove)
+
+    if not dry_run:
+        for path in remove:
+            shutil.rmtree(path)
+
+    return {
+        'kept': sorted(keep),
+        'removed': remove,
+        'inodes': inodes,
+        'bytes': n_bytes,
+    }
+
+
+def compact(local_raw: os.PathLike, dry_run: bool = False) -> dict:
+    """
+    Hard-link identical files between consecutive snapshots.
+
+    rsync --link-dest already does this for new snapshots, but snapshots made without it,
+    or copied without preserving hard links, can hold separate copies of the same file.
+    Files are only linked if they have the same relative path, size, mtime and content.
+
+    Returns:
+        Report with the number of files linked, and the inodes and bytes reclaimed.
+    """
+    snapshots = [path for _, path in sorted(list_snapshots(local_raw))]
+    linked, inodes, n_bytes = 0, 0, 0
+    for previous, current in zip(snapshots, snapshots[1:]):
+        for root, _, files in os.walk(current):
+            for name in files:
+                path = os.path.join(root, name)
+                other = os.path.join(previous, os.path.relpath(path, current))
+                try:
+                    stat, other_stat = os.lstat(path), os.lstat(other)
+                except FileNotFoundError:
+                    continue
+                if (stat.st_dev, stat.st_ino) == (other_stat.st_dev, other_stat.st_ino):
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (other_stat.st_size, other_stat.st_mtime_ns):
+                    continue
+                if not filecmp.cmp(path, other, shallow=False):
+                    continue
+
+                linked += 1
+                if stat.st_nlink == 1:
+                    inodes += 1
+                    n_bytes += stat.st_size
+                if not dry_run:
+                    tmp_path = path + '.compact_tmp'
+                    os.link(other, tmp_path)
+                    os.replace(tmp_path, path)
+
+    return {
+        'linked': linked,
+        'inodes': inodes,
+        'bytes': n_bytes,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune and compact the raw snapshots made by sync")
+    parser.add_argument('local_raw', help="Directory holding the snapshots")
+    parser.add_argument('--keep-hourly', type=int, default=24)
+    parser.add_argument('--keep-daily', type=int, default=7)
+    parser.add_argument('--keep-weekly', type=int, default=4)
+    parser.add_argument('--keep-monthly', type=int, default=12)
+    parser.add_argument('--compact', help="Also hard-link identical files between snapshots", action='store_true')
+    parser.add_argument('-n', '--dry-run', help="Only report what would be done", action='store_true')
+    args = parser.parse_args()
+
+    if args.compact:
+        report = compact(args.local_raw, args.dry_run)
+        print(f"Linked {report['linked']} files, reclaiming {report['inodes']} inodes and {report['bytes']} bytes")
+
+    report = prune(args.local_raw, args.keep_hourly, args.keep_daily, args.keep_weekly, args.keep_monthly, args.dry_run)
+    print(f"Kept {len(report['kept'])} snapshots, removed {len(report['removed'])}, "
+          f"reclaiming {report['inodes']} inodes and {report['bytes']} bytes")
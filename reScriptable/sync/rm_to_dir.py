@@ -1,11 +1,20 @@
 
 import os
 import json
+import sys
 
 from glob import glob
+from typing import Optional
 
-from ..exporter.pdf_export import RMToPDF
-from ..exporter.line_reader import RMDocument
+from .metadata_index import MetadataIndex
+from .changes import ChangeSet, diff_snapshots
+from .. import profiling
+
+# The exporter, with numpy and Pillow, and the process pool are imported by the functions
+# using them, so that runs with nothing to export start quickly
+
+# Written to the output directory by to_readable, see is_up_to_date
+EXPORT_STATE = 'export_state.json'
 
 
 class RMFileTypes:
@@ -32,9 +41,13 @@ class RMFileName:
 
 
 class RMDirectory:
-    def __init__(self, rm_path):
+    def __init__(self, rm_path, index: Optional[MetadataIndex] = None):
+        """
+        Args:
+            rm_path: The xochitl directory.
+            index: If given, metadata is read through the index, which only parses files that changed.
+        """
         self.rm_path = rm_path
-        paths = glob(os.path.join(rm_path, '*.metadata'))
 
         trash = RMFileName('trash', {
             'visibleName': 'trash',
@@ -44,57 +57,87 @@ class RMDirectory:
 
         self.rmfiles = {'trash': trash}
 
-        self.structure = {}
+        with profiling.timer('metadata'):
+            if index is not None:
+                metadata = index.load(rm_path)
+            else:
+                metadata = {}
+                for p in glob(os.path.join(rm_path, '*.metadata')):
+                    uuid = p.rsplit("/")[-1].rsplit(".")[0]
+                    with open(p) as f:
+                        metadata[uuid] = json.loads(f.read())
+            profiling.count('metadata_files', len(metadata))
 
-        for p in paths:
-            uuid = p.rsplit("/")[-1].rsplit(".")[0]
-            with open(p) as f:
-                data = json.loads(f.read())
+            for uuid, data in metadata.items():
+                self._add_file(uuid, data)
 
-            self.rmfiles[uuid] = RMFileName(uuid, data)
-            if self.rmfiles[uuid].type not in RMFileTypes.ALL_TYPES:
-                raise ValueError(
-                    f"Unknown file type: {self.rmfiles[uuid].type}")
+            self._build_structure()
 
-        handled = ['trash']
-        elems = list(self.rmfiles.values())
-        while elems:
-            cur_elem = elems.pop(0)
-            if cur_elem == trash:
+    def _add_file(self, uuid, data):
+        self.rmfiles[uuid] = RMFileName(uuid, data)
+        if self.rmfiles[uuid].type not in RMFileTypes.ALL_TYPES:
+            raise ValueError(
+                f"Unknown file type: {self.rmfiles[uuid].type}")
+
+    def update(self, changes: ChangeSet):
+        """
+        Apply the changes of a new snapshot, re-reading only the metadata of changed files.
+        rm_path should point to the new snapshot, e.g. through the latest link.
+        """
+        for uuid in changes.deleted:
+            self.rmfiles.pop(uuid, None)
+        for uuid in changes.added | changes.modified | changes.moved:
+            path = os.path.join(self.rm_path, f"{uuid}.metadata")
+            if not os.path.exists(path):
                 continue
-            if cur_elem.parent is None:
-                uuid = cur_elem.uuid
-                if cur_elem.type == RMFileTypes.FOLDER:
-                    element = {}
-                elif cur_elem.type == RMFileTypes.DOCUMENT:
-                    element = cur_elem.name
-                self.structure[uuid] = element
-                handled.append(uuid)
-
-            elif cur_elem.parent in handled:
-                cur_folder = self.rmfiles[cur_elem.parent]
-                placement = [cur_elem.parent]
-                while cur_folder.parent is not None:
-                    cur_folder = self.rmfiles[cur_folder.parent]
-                    placement.append(cur_folder)
-
-                if cur_folder == trash:
-                    continue
+            with open(path) as f:
+                self._add_file(uuid, json.loads(f.read()))
+        self._build_structure()
+
+    def _build_structure(self):
+        """
+        Build the folder tree in self.structure from the parent of each file.
 
-                structure_choice = self.structure
-                for par in placement[::-1]:
-                    structure_choice = structure_choice[par]
+        Folders map uuid to a dict of their contents, documents map uuid to their name.
+        Files in the trash are left out. Files whose parent does not exist are put at the
+        top level, and files that cannot be reached from the top level or the trash
+        (parent cycles) are left out. Both are reported on stderr, and their uuids kept in
+        self.orphans and self.unreachable.
+        """
+        children = {}
+        self.orphans = []
+        for uuid, f in self.rmfiles.items():
+            if uuid == 'trash':
+                continue
+            parent = f.parent
+            if parent is not None and parent not in self.rmfiles:
+                self.orphans.append(uuid)
+                parent = None
+            children.setdefault(parent, []).append(uuid)
 
-                uuid = cur_elem.uuid
-                if cur_elem.type == RMFileTypes.FOLDER:
+        self.structure = {}
+        visited = {'trash'}
+        stack = [(None, self.structure), ('trash', None)]
+        while stack:
+            parent, node = stack.pop()
+            for uuid in children.get(parent, ()):
+                visited.add(uuid)
+                f = self.rmfiles[uuid]
+                if f.type == RMFileTypes.FOLDER:
                     element = {}
-                elif cur_elem.type == RMFileTypes.DOCUMENT:
-                    element = cur_elem.name
-                structure_choice[uuid] = element
-                handled.append(uuid)
+                    stack.append((uuid, element if node is not None else None))
+                else:
+                    element = f.name
+                if node is not None:
+                    node[uuid] = element
 
-            else:
-                elems.append(cur_elem)
+        self.unreachable = [uuid for uuid in self.rmfiles if uuid not in visited]
+
+        for uuid in self.orphans:
+            print(f"Warning: parent of '{self.rmfiles[uuid].name}' ({uuid}) not found, placing it at the top level",
+                  file=sys.stderr)
+        for uuid in self.unreachable:
+            print(f"Warning: '{self.rmfiles[uuid].name}' ({uuid}) is in a folder cycle, skipping it", file=sys.stderr)
 
     def print_structure(self, tree=None, start=''):
         tree = tree if tree is not None else self.structure
@@ -105,41 +148,373 @@ class RMDirectory:
                 print(f"{start}{self.rmfiles[uuid].name}:")
                 self.print_structure(elem, start + '\t')
 
-    def to_readable(self, out_dir='out', tree=None, only_update=True):
+    def to_readable(self, out_dir='out', tree=None, only_update=True, jobs=1, backend='inkscape',
+                    cache_dir=None, cache_size=512 * 1024 * 1024, changes: Optional[ChangeSet] = None,
+                    decoded_cache_dir=None, template_dirs=None, template_cache_dir=None):
+        """
+        Export the directory as a tree of folders and PDFs.
+
+        PDFs of documents that were renamed or moved since the last export are moved along,
+        and PDFs of documents that were deleted or trashed are removed.
+
+        Args:
+            out_dir: Where to put the exported tree.
+            tree: Subtree to export, defaults to the whole structure. Only the outputs of documents
+                in it are moved, and none are removed.
+            only_update: If True, skip documents that have not changed since the last export.
+            jobs: Number of worker processes used to export documents.
+            backend: PDF backend passed on to RMToPDF.write.
+            cache_dir: Directory of a PageCache shared by all exports, or None to not cache pages.
+            cache_size: Maximum size of the page cache in bytes.
+            changes: Changes since the snapshot of the last export, as returned by sync. Documents
+                modified according to it are exported even if their lastModified is unchanged.
+            decoded_cache_dir: Directory of a DecodedPageCache shared by all exports, or None to
+                decode every page from its .rm file.
+            template_dirs, template_cache_dir: Where to find page templates and cache them prepared,
+                see export_document.
+
+        Returns:
+            A dict mapping the uuid of every document that failed to export to its exception.
+        """
         os.makedirs(out_dir, exist_ok=True)
-        first = False
-        if isinstance(only_update, bool):
-            first = True
-            if only_update and os.path.exists(os.path.join(out_dir, 'last_modified.json')):
-                with open(os.path.join(out_dir, 'last_modified.json')) as f:
-                    only_update = json.loads(f.read())
-            else:
-                only_update = {}
+        last_modified_path = os.path.join(out_dir, 'last_modified.json')
+        exported_path = os.path.join(out_dir, 'exported.json')
+        if only_update and os.path.exists(last_modified_path):
+            with open(last_modified_path) as f:
+                last_modified = json.loads(f.read())
+        else:
+            last_modified = {}
+        if os.path.exists(exported_path):
+            with open(exported_path) as f:
+                previous_paths = json.loads(f.read())
+        else:
+            previous_paths = {}
 
+        complete = tree is None
         if tree is None:
             tree = self.structure
 
+        if changes is not None:
+            for uuid in changes.added | changes.modified:
+                last_modified.pop(uuid, None)
+
+        paths = {}
+        stale = self._find_stale(out_dir, tree, last_modified, paths)
+
+        # Outputs of documents outside of a subtree are left alone, but still count as taken
+        others = {} if complete else {uuid: os.path.join(out_dir, rel_path)
+                                      for uuid, rel_path in previous_paths.items() if uuid not in paths}
+        moved = {uuid: rel_path for uuid, rel_path in previous_paths.items() if uuid not in others}
+        rewrite = self._move_outputs(out_dir, moved, paths, others)
+        stale_uuids = {uuid for uuid, _ in stale}
+        stale.extend((uuid, paths[uuid]) for uuid in sorted(rewrite) if uuid not in stale_uuids)
+
+        failed = {}
+        if jobs > 1 and len(stale) > 1:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # Workers have their own timers, so they send them back to be merged here
+                futures = {executor.submit(export_document, self.rm_path, uuid, out_name, backend, cache_dir, cache_size,
+                                           profiling.enabled, decoded_cache_dir, template_dirs,
+                                           template_cache_dir, page_jobs(jobs)): uuid
+                           for uuid, out_name in stale}
+                for future in as_completed(futures):
+                    uuid = futures[future]
+                    try:
+                        profiling.merge(future.result())
+                    except Exception as e:
+                        failed[uuid] = e
+                    else:
+                        last_modified[uuid] = self.rmfiles[uuid].last_modified
+        else:
+            for uuid, out_name in stale:
+                try:
+                    export_document(self.rm_path, uuid, out_name, backend, cache_dir, cache_size,
+                                    decoded_cache_dir=decoded_cache_dir, template_dirs=template_dirs,
+                                    template_cache_dir=template_cache_dir)
+                except Exception as e:
+                    failed[uuid] = e
+                else:
+                    last_modified[uuid] = self.rmfiles[uuid].last_modified
+
+        if stale:
+            evict_caches(cache_dir, cache_size, decoded_cache_dir)
+
+        profiling.count('documents_exported', len(stale) - len(failed))
+        profiling.count('documents_failed', len(failed))
+        for uuid, e in failed.items():
+            print(f"Failed to export '{self.rmfiles[uuid].name}' ({uuid}): {e}", file=sys.stderr)
+
+        exported = {uuid: os.path.relpath(path, out_dir) for uuid, path in {**others, **paths}.items()
+                    if os.path.exists(path)}
+
+        write_json_atomic(last_modified_path, last_modified)
+        write_json_atomic(exported_path, exported)
+        write_json_atomic(os.path.join(out_dir, EXPORT_STATE),
+                          {'snapshot': os.path.realpath(self.rm_path), 'complete': complete and not failed})
+
+        return failed
+
+    def gallery(self, out_dir, max_size=256, jobs=1, decoded_cache_dir=None):
+        """
+        Render the first page of every document to a thumbnail, for a preview of the whole library
+        without exporting any PDFs.
+
+        Thumbnails are written to out_dir/<uuid>.png, and out_dir/index.json lists the name,
+        folder, lastModified and thumbnail of every document. Thumbnails of documents that did
+        not change since the last run are kept, and those of documents that are gone are removed.
+
+        Args:
+            max_size: Maximum width and height of the thumbnails.
+            jobs: Number of worker processes used to render thumbnails.
+            decoded_cache_dir: Directory of a DecodedPageCache to load pages through, if any.
+
+        Returns:
+            A dict mapping the uuid of every document that failed to render to its exception.
+        """
+        from ..exporter.raster_export import write_thumbnail
+
+        os.makedirs(out_dir, exist_ok=True)
+        index_path = os.path.join(out_dir, 'index.json')
+        previous = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                data = json.loads(f.read())
+            if data.get('max_size') == max_size:
+                previous = data['documents']
+
+        documents = {}
+        stale = []
+        stack = [(self.structure, '')]
+        while stack:
+            tree, folder = stack.pop()
+            for uuid, elem in tree.items():
+                f = self.rmfiles[uuid]
+                if f.type == RMFileTypes.FOLDER:
+                    stack.append((elem, os.path.join(folder, f.name)))
+                    continue
+                documents[uuid] = {'name': f.name, 'folder': folder, 'lastModified': f.last_modified,
+                                   'thumbnail': f"{uuid}.png"}
+                old = previous.get(uuid)
+                if (old is None or old['lastModified'] != f.last_modified
+                        or not os.path.exists(os.path.join(out_dir, f"{uuid}.png"))):
+                    stale.append(uuid)
+
+        for uuid in previous:
+            if uuid not in documents and os.path.exists(os.path.join(out_dir, f"{uuid}.png")):
+                os.remove(os.path.join(out_dir, f"{uuid}.png"))
+
+        failed = {}
+        args = [(self.rm_path, uuid, os.path.join(out_dir, f"{uuid}.png"), max_size, 0, 2, decoded_cache_dir)
+                for uuid in stale]
+        if jobs > 1 and len(stale) > 1:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {executor.submit(write_thumbnail, *a): a[1] for a in args}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[futures[future]] = e
+        else:
+            for a in args:
+                try:
+                    write_thumbnail(*a)
+                except Exception as e:
+                    failed[a[1]] = e
+
+        if stale:
+            evict_caches(decoded_cache_dir=decoded_cache_dir)
+
+        for uuid, e in failed.items():
+            print(f"Failed to render '{self.rmfiles[uuid].name}' ({uuid}): {e}", file=sys.stderr)
+            # Leave it out of the index, so it is tried again next time
+            del documents[uuid]
+
+        write_json_atomic(index_path, {'max_size': max_size, 'documents': documents})
+        return failed
+
+    def _find_stale(self, out_dir, tree, last_modified, paths):
+        """
+        Create the folders of tree under out_dir, and find the documents that need to be exported.
+
+        The output path of every document in tree is stored in paths.
+
+        Returns:
+            List of (uuid, output path) for every document that has changed.
+        """
+        stale = []
         for uuid, elem in tree.items():
             f = self.rmfiles[uuid]
             if f.type == RMFileTypes.FOLDER:
-                only_update[uuid] = f.last_modified
+                last_modified[uuid] = f.last_modified
                 new_dir = os.path.join(out_dir, f.name)
                 os.makedirs(new_dir, exist_ok=True)
-                self.to_readable(new_dir, elem, only_update)
+                stale.extend(self._find_stale(new_dir, elem, last_modified, paths))
             elif f.type == RMFileTypes.DOCUMENT:
-                if uuid in only_update and only_update[uuid] == f.last_modified:
+                paths[uuid] = os.path.join(out_dir, f"{f.name}.pdf")
+                if last_modified.get(uuid) == f.last_modified:
                     continue
-                only_update[uuid] = f.last_modified
-                doc = RMDocument(self.rm_path, uuid)
-                to_pdf = RMToPDF(doc)
-                out_name = os.path.join(out_dir, f"{f.name}.pdf")
-                to_pdf.write(out_name)
+                stale.append((uuid, paths[uuid]))
             else:
                 raise ValueError(f"Unknown document type: {f.type}")
+        return stale
+
+    @staticmethod
+    def _move_outputs(out_dir, previous_paths, paths, others=None):
+        """
+        Move PDFs whose document has a new output path, and remove PDFs of documents that are gone.
+
+        Documents with the same name in the same folder share their output path. A PDF is never
+        removed or moved while it is still the output of another document, and never moved onto
+        the output of another document.
+
+        Args:
+            previous_paths: Output paths of the last export, relative to out_dir.
+            paths: Current output paths.
+            others: Output paths of other documents, which are not moved but must not be touched.
+
+        Returns:
+            The uuids of documents in paths that have to be exported again: those that could not
+            be moved, and those sharing a PDF that may have been written by a document that is
+            gone or moved.
+        """
+        owners = {}
+        for uuid, path in {**(others or {}), **paths}.items():
+            owners.setdefault(os.path.abspath(path), set()).add(uuid)
+
+        rewrite = set()
+        emptied = set()
+        for uuid, rel_path in previous_paths.items():
+            old_path = os.path.join(out_dir, rel_path)
+            new_path = paths.get(uuid)
+            if new_path is not None and os.path.abspath(new_path) == os.path.abspath(old_path):
+                continue
+            if not os.path.exists(old_path):
+                continue
+
+            sharing = owners.get(os.path.abspath(old_path), set()) - {uuid}
+            if sharing:
+                rewrite.update(sharing & paths.keys())
+                if new_path is not None and not os.path.exists(new_path):
+                    rewrite.add(uuid)
+                continue
+
+            if new_path is None:
+                os.remove(old_path)
+            elif owners[os.path.abspath(new_path)] - {uuid}:
+                os.remove(old_path)
+                if not os.path.exists(new_path):
+                    rewrite.add(uuid)
+            else:
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+            emptied.add(os.path.dirname(old_path))
+
+        # Remove folders that were left empty, deepest first
+        for folder in sorted(emptied, key=len, reverse=True):
+            while os.path.abspath(folder) != os.path.abspath(out_dir):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+
+        return rewrite
+
+
+def is_up_to_date(rm_path, out_dir, changes: Optional[ChangeSet] = None) -> bool:
+    """
+    Check whether to_readable has nothing to do for a snapshot, without loading any metadata.
+
+    That is the case if the last to_readable into out_dir exported every document without
+    failures, and the snapshot it exported has the same files as rm_path.
+
+    Args:
+        rm_path: The xochitl directory of the snapshot.
+        changes: Changes since the previous snapshot, if known. Saves comparing the snapshots
+            when there are any.
+    """
+    if changes:
+        return False
+    try:
+        with open(os.path.join(out_dir, EXPORT_STATE)) as f:
+            state = json.loads(f.read())
+    except (OSError, ValueError):
+        return False
+    if not state.get('complete'):
+        return False
+
+    exported = state['snapshot']
+    if exported == os.path.realpath(rm_path):
+        return True
+    # Unchanged files are hard links between snapshots, so this only compares inodes
+    return os.path.isdir(exported) and not diff_snapshots(exported, rm_path)
+
+
+def write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w+') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def evict_caches(cache_dir=None, cache_size=512 * 1024 * 1024, decoded_cache_dir=None):
+    """
+    Evict the page cache and the decoded page cache, if any. Evicting scans the whole cache,
+    so it is done once per run rather than after every document.
+    """
+    from ..exporter.decoded_cache import DecodedPageCache
+    from ..exporter.page_cache import PageCache
+
+    if cache_dir is not None:
+        PageCache(cache_dir, cache_size).evict()
+    if decoded_cache_dir is not None:
+        DecodedPageCache(decoded_cache_dir).evict()
+
+
+def page_jobs(document_jobs):
+    """
+    Number of pages each export converts concurrently while document_jobs documents are exported
+    at a time, so that all of them together use about one process per CPU.
+    """
+    return max(1, (os.cpu_count() or 1) // document_jobs)
+
+
+def export_document(rm_path, uuid, out_name, backend='inkscape', cache_dir=None, cache_size=512 * 1024 * 1024,
+                    profile=False, decoded_cache_dir=None, template_dirs=None, template_cache_dir=None, jobs=None):
+    """
+    Export a single document to out_name.
+
+    Args:
+        profile: Enable profiling and return the collected timers and counters. Used when
+            running in a worker process, in-process exports are recorded directly.
+        decoded_cache_dir: Directory of a DecodedPageCache to load pages through, if any.
+        template_dirs: Directories to find page templates in, None for the ones shipped with
+            reScriptable, or an empty list to leave page backgrounds blank.
+        template_cache_dir: Directory to keep templates prepared for drawing in, if any.
+        jobs: Number of pages converted concurrently, see RMToPDF. Pass page_jobs(n) when
+            n documents are exported at the same time.
+    """
+    from ..exporter.decoded_cache import DecodedPageCache
+    from ..exporter.line_reader import RMDocument
+    from ..exporter.page_cache import PageCache
+    from ..exporter.pdf_export import RMToPDF
+    from ..exporter.templates import TemplateLibrary
 
-        if first:
-            with open(os.path.join(out_dir, 'last_modified.json'), 'w+') as f:
-                json.dump(only_update, f)
+    if profile:
+        profiling.enable()
+        # Drop anything inherited from the parent when the worker was forked
+        profiling.collect()
+    with profiling.timer('export'):
+        decoded = DecodedPageCache(decoded_cache_dir) if decoded_cache_dir is not None else None
+        doc = RMDocument(rm_path, uuid, cache=decoded)
+        cache = PageCache(cache_dir, cache_size) if cache_dir is not None else None
+        templates = TemplateLibrary(template_dirs, template_cache_dir) if template_dirs != [] else None
+        to_pdf = RMToPDF(doc, jobs=jobs, cache=cache, templates=templates)
+        to_pdf.write(out_name, backend)
+    if profile:
+        return profiling.collect()
 
 
 if __name__ == "__main__":
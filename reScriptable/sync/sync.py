@@ -2,34 +2,84 @@ import sys
 import subprocess
 import datetime
 import os
+import shutil
 
-def sync(host, remote_dir, local_dir):
+from .changes import diff_snapshots
+from .. import profiling
+
+
+def new_snapshot(local_dir):
+    """
+    Create the directory for a new snapshot in local_dir.
+
+    Returns:
+        (path of the new snapshot, path of the latest link)
+    """
     now = str(datetime.datetime.now())
 
     backup_path = f"{local_dir}/{now}"
     latest_link = f"{local_dir}/latest"
 
     os.makedirs(backup_path)
+    return backup_path, latest_link
+
 
-    res = subprocess.run([
+def rsync_command(host, remote_dir, backup_path, latest_link, extra_args=()):
+    return [
         "/usr/bin/rsync",
         "-avp",
         "--timeout",
         "10",
         "--delete",
+        *extra_args,
         f"{host}:{remote_dir}",
         "--link-dest", latest_link,
         "--exclude", ".cache",
         backup_path
-    ])
+    ]
 
-    if res.returncode != 0:
-        raise OSError(f"Sync returned code: {res.returncode}")
 
+def finish_snapshot(remote_dir, backup_path, latest_link):
+    """
+    Point the latest link to a completed snapshot.
+
+    Returns:
+        The ChangeSet between the previous and the new snapshot, also saved as changes.json
+        in the new snapshot, or None if there was no previous snapshot.
+    """
+    changes = None
     if os.path.exists(latest_link):
+        xochitl = os.path.basename(remote_dir.rstrip('/'))
+        previous = os.path.join(os.path.realpath(latest_link), xochitl)
+        if os.path.isdir(previous):
+            changes = diff_snapshots(previous, os.path.join(backup_path, xochitl))
+            changes.save(os.path.join(backup_path, 'changes.json'))
+
+    if os.path.lexists(latest_link):
         os.remove(latest_link)
     os.symlink(backup_path, latest_link, True)
 
+    return changes
+
+
+def sync(host, remote_dir, local_dir):
+    """
+    Make a new snapshot of remote_dir in local_dir, and point local_dir/latest to it.
+
+    Returns:
+        The ChangeSet between the previous and the new snapshot, see finish_snapshot.
+    """
+    backup_path, latest_link = new_snapshot(local_dir)
+
+    with profiling.timer('rsync'):
+        res = subprocess.run(rsync_command(host, remote_dir, backup_path, latest_link))
+
+    if res.returncode != 0:
+        shutil.rmtree(backup_path)
+        raise OSError(f"Sync returned code: {res.returncode}")
+
+    return finish_snapshot(remote_dir, backup_path, latest_link)
+
 
 if __name__ == "__main__":
     sync(1, 2, 3)
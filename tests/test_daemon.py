@@ -0,0 +1,54 @@
+import os
+
+from benchmarks.synthetic import write_document
+from reScriptable.sync import rm_to_dir
+from reScriptable.sync.changes import diff_snapshots
+from reScriptable.sync.daemon import SyncDaemon
+
+from .test_move_outputs import pdf_files
+from .test_retention import make_snapshot, point_latest
+
+
+def add_snapshot(local_raw, name, previous, uuid, doc_name):
+    """
+    Make a snapshot with one more document, and point latest to it like sync does.
+    """
+    path = make_snapshot(local_raw, name, previous)
+    write_document(os.path.join(path, 'xochitl'), uuid, doc_name, n_strokes=5)
+    diff_snapshots(os.path.join(local_raw, previous, 'xochitl'),
+                   os.path.join(path, 'xochitl')).save(os.path.join(path, 'changes.json'))
+    point_latest(local_raw, path)
+
+
+def test_daemon_applies_the_changes_of_skipped_snapshots(tmp_path):
+    local_raw, local_nice = str(tmp_path / 'raw'), str(tmp_path / 'nice')
+    point_latest(local_raw, make_snapshot(local_raw, '2024-01-01 10:00:00'))
+    daemon = SyncDaemon(None, None, local_raw, local_nice, do_sync=False, backend='native')
+    daemon.run_once()
+    assert pdf_files(local_nice) == ['Document.pdf']
+
+    # Two snapshots made by another process between polls
+    add_snapshot(local_raw, '2024-01-01 11:00:00', '2024-01-01 10:00:00', 'b', 'Second')
+    add_snapshot(local_raw, '2024-01-01 12:00:00', '2024-01-01 11:00:00', 'c', 'Third')
+    daemon.run_once()
+    assert pdf_files(local_nice) == ['Document.pdf', 'Second.pdf', 'Third.pdf']
+
+
+def test_daemon_retries_failed_documents_without_new_snapshot(tmp_path, monkeypatch):
+    local_raw, local_nice = str(tmp_path / 'raw'), str(tmp_path / 'nice')
+    point_latest(local_raw, make_snapshot(local_raw, '2024-01-01 10:00:00'))
+    export_document = rm_to_dir.export_document
+
+    def failing(*args, **kwargs):
+        raise OSError("pdftk returned code: 1")
+    monkeypatch.setattr(rm_to_dir, 'export_document', failing)
+
+    daemon = SyncDaemon(None, None, local_raw, local_nice, do_sync=False, backend='native')
+    daemon.run_once()
+    assert daemon.status['failed_documents'] == 1
+    assert pdf_files(local_nice) == []
+
+    monkeypatch.setattr(rm_to_dir, 'export_document', export_document)
+    daemon.run_once()
+    assert daemon.status['failed_documents'] == 0
+    assert pdf_files(local_nice) == ['Document.pdf']
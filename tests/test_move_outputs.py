@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from benchmarks.synthetic import write_document, write_folder
+from reScriptable.sync.rm_to_dir import RMDirectory
+
+
+def export(xochitl, out_dir, **kwargs):
+    failed = RMDirectory(str(xochitl)).to_readable(str(out_dir), backend='native', **kwargs)
+    assert failed == {}
+    with open(os.path.join(out_dir, 'exported.json')) as f:
+        return json.load(f)
+
+
+def set_metadata(xochitl, uuid, **values):
+    path = os.path.join(xochitl, f'{uuid}.metadata')
+    with open(path) as f:
+        metadata = json.load(f)
+    metadata.update(values)
+    with open(path, 'w') as f:
+        json.dump(metadata, f)
+
+
+def delete(xochitl, uuid):
+    for name in os.listdir(xochitl):
+        if name.split('.', 1)[0] == uuid:
+            path = os.path.join(xochitl, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def pdf_files(out_dir):
+    return sorted(os.path.relpath(os.path.join(root, name), out_dir)
+                  for root, _, names in os.walk(out_dir) for name in names if name.endswith('.pdf'))
+
+
+@pytest.fixture
+def xochitl(tmp_path):
+    path = tmp_path / 'xochitl'
+    path.mkdir()
+    return path
+
+
+def test_rename_moves_the_pdf(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_document(xochitl, 'a', 'Old', n_strokes=5)
+    export(xochitl, out_dir)
+    with open(out_dir / 'Old.pdf', 'rb') as f:
+        content = f.read()
+
+    set_metadata(xochitl, 'a', visibleName='New')
+    assert export(xochitl, out_dir) == {'a': 'New.pdf'}
+    assert pdf_files(out_dir) == ['New.pdf']
+    with open(out_dir / 'New.pdf', 'rb') as f:
+        assert f.read() == content
+
+
+def test_move_to_folder_moves_the_pdf_and_removes_empty_folders(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_folder(xochitl, 'f', 'Folder')
+    write_folder(xochitl, 'g', 'Other')
+    write_document(xochitl, 'a', 'Notes', parent='g', n_strokes=5)
+    export(xochitl, out_dir)
+    assert pdf_files(out_dir) == [os.path.join('Other', 'Notes.pdf')]
+
+    set_metadata(xochitl, 'a', parent='f')
+    delete(xochitl, 'g')
+    assert export(xochitl, out_dir) == {'a': os.path.join('Folder', 'Notes.pdf')}
+    assert pdf_files(out_dir) == [os.path.join('Folder', 'Notes.pdf')]
+    assert not os.path.exists(out_dir / 'Other')
+
+
+def test_delete_removes_the_pdf(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_document(xochitl, 'a', 'Gone', n_strokes=5)
+    write_document(xochitl, 'b', 'Kept', n_strokes=5)
+    export(xochitl, out_dir)
+
+    delete(xochitl, 'a')
+    assert export(xochitl, out_dir) == {'b': 'Kept.pdf'}
+    assert pdf_files(out_dir) == ['Kept.pdf']
+
+
+def test_delete_keeps_a_pdf_shared_with_a_duplicate_name(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_document(xochitl, 'a', 'Notebook', n_strokes=5)
+    write_document(xochitl, 'b', 'Notebook', n_strokes=5, seed=1)
+    export(xochitl, out_dir)
+
+    delete(xochitl, 'a')
+    assert export(xochitl, out_dir) == {'b': 'Notebook.pdf'}
+    assert pdf_files(out_dir) == ['Notebook.pdf']
+
+    # The survivor is exported again, in case the PDF was written by the deleted document
+    expected = tmp_path / 'expected'
+    export(xochitl, expected)
+    with open(out_dir / 'Notebook.pdf', 'rb') as f, open(expected / 'Notebook.pdf', 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_rename_away_from_a_duplicate_name_keeps_both(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_document(xochitl, 'a', 'Notebook', n_strokes=5)
+    write_document(xochitl, 'b', 'Notebook', n_strokes=5, seed=1)
+    export(xochitl, out_dir)
+
+    set_metadata(xochitl, 'a', visibleName='Renamed')
+    assert export(xochitl, out_dir) == {'a': 'Renamed.pdf', 'b': 'Notebook.pdf'}
+    assert pdf_files(out_dir) == ['Notebook.pdf', 'Renamed.pdf']
+
+
+def test_rename_onto_an_existing_name_does_not_replace_its_pdf(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_document(xochitl, 'a', 'First', n_strokes=5)
+    write_document(xochitl, 'b', 'Second', n_strokes=5, seed=1)
+    export(xochitl, out_dir)
+    with open(out_dir / 'Second.pdf', 'rb') as f:
+        second = f.read()
+
+    set_metadata(xochitl, 'a', visibleName='Second')
+    assert export(xochitl, out_dir) == {'a': 'Second.pdf', 'b': 'Second.pdf'}
+    assert pdf_files(out_dir) == ['Second.pdf']
+    with open(out_dir / 'Second.pdf', 'rb') as f:
+        assert f.read() == second
+
+
+def test_subtree_export_leaves_other_outputs_alone(xochitl, tmp_path):
+    out_dir = tmp_path / 'nice'
+    write_folder(xochitl, 'f', 'Folder')
+    write_document(xochitl, 'a', 'Inside', parent='f', n_strokes=5)
+    write_document(xochitl, 'b', 'Outside', n_strokes=5)
+    export(xochitl, out_dir)
+
+    direc = RMDirectory(str(xochitl))
+    direc.to_readable(str(out_dir), tree=direc.structure['f'], only_update=False, backend='native')
+    with open(out_dir / 'exported.json') as f:
+        exported = json.load(f)
+    assert exported['b'] == 'Outside.pdf'
+    assert os.path.exists(out_dir / 'Outside.pdf')
@@ -0,0 +1,113 @@
+import filecmp
+import os
+import shutil
+
+import pytest
+
+from benchmarks.synthetic import write_content, write_document
+from reScriptable.sync import pipeline
+from reScriptable.sync.pipeline import TransferTracker
+
+from .test_move_outputs import set_metadata
+
+
+def test_tracker_waits_for_the_page_directory():
+    tracker = TransferTracker('xochitl')
+    done = []
+    for path in ['xochitl/',
+                 'xochitl/a.content', 'xochitl/a.pagedata', 'xochitl/b.content', 'xochitl/c.metadata',
+                 'xochitl/a.thumbnails/', 'xochitl/a.thumbnails/0.png',
+                 'xochitl/a/', 'xochitl/a/0.rm',
+                 'xochitl/b.highlights/', 'xochitl/b.highlights/0.json',
+                 'xochitl/b.thumbnails/',
+                 'xochitl/b/', 'xochitl/b/0.rm', 'xochitl/b/1.rm',
+                 'xochitl/c/']:
+        done.append((path, tracker.feed(path)))
+    done.append(('end', tracker.finish()))
+
+    assert [(path, uuids) for path, uuids in done if uuids] == [
+        ('xochitl/b.highlights/', ['a']),
+        ('xochitl/c/', ['b']),
+        ('end', ['c']),
+    ]
+
+
+def test_tracker_ignores_directories_without_reported_files():
+    tracker = TransferTracker('xochitl')
+    assert tracker.feed('xochitl/a/') == []
+    assert tracker.feed('xochitl/b/') == []
+    assert tracker.finish() == []
+
+
+def rsync_order(root, rel=''):
+    """
+    The paths under root in the order rsync --no-inc-recursive sends them.
+    """
+    entries = sorted(os.listdir(os.path.join(root, rel)))
+    files = [name for name in entries if not os.path.isdir(os.path.join(root, rel, name))]
+    dirs = sorted((name for name in entries if name not in files), key=lambda name: name + '/')
+    paths = [os.path.join(rel, name) for name in files]
+    for name in dirs:
+        paths.append(os.path.join(rel, name) + '/')
+        paths.extend(rsync_order(root, os.path.join(rel, name)))
+    return paths
+
+
+def fake_rsync(tablet):
+    """
+    Stand-in for _run_rsync copying from tablet like rsync --link-dest would.
+    """
+    async def run(cmd, on_path=None):
+        backup_path, latest = cmd[-1], cmd[cmd.index('--link-dest') + 1]
+        only_metadata = '--exclude' in cmd and '*' in cmd
+        for path in ['xochitl/'] + ['xochitl/' + p for p in rsync_order(os.path.join(tablet, 'xochitl'))]:
+            src, dst, old = (os.path.join(d, path) for d in (tablet, backup_path, latest))
+            if path.endswith('/'):
+                os.makedirs(dst, exist_ok=True)
+                continue
+            if only_metadata and not path.endswith('.metadata'):
+                continue
+            if os.path.exists(dst):
+                continue
+            if os.path.exists(old) and filecmp.cmp(src, old, shallow=False):
+                os.link(old, dst)
+                continue
+            shutil.copy2(src, dst)
+            if on_path is not None:
+                on_path(path)
+    return run
+
+
+def test_pipeline_exports_renamed_documents_with_their_new_ink(tmp_path, monkeypatch):
+    tablet = tmp_path / 'tablet'
+    xochitl = tablet / 'xochitl'
+    xochitl.mkdir(parents=True)
+    local_raw, local_nice = tmp_path / 'raw', tmp_path / 'nice'
+    local_raw.mkdir()
+    monkeypatch.setattr(pipeline, '_run_rsync', fake_rsync(tablet))
+
+    write_document(xochitl, 'a', 'Old', n_strokes=5)
+    pipeline.run_pipeline('host', '/home/root/xochitl', str(local_raw), str(local_nice), backend='native')
+    with open(local_nice / 'Old.pdf', 'rb') as f:
+        old = f.read()
+
+    set_metadata(xochitl, 'a', visibleName='New', lastModified='2')
+    write_content(xochitl, 'a', n_strokes=50, seed=1)
+    pipeline.run_pipeline('host', '/home/root/xochitl', str(local_raw), str(local_nice), backend='native')
+
+    assert sorted(name for name in os.listdir(local_nice) if name.endswith('.pdf')) == ['New.pdf']
+    with open(local_nice / 'New.pdf', 'rb') as f:
+        assert f.read() != old
+
+
+def test_pipeline_removes_the_snapshot_when_the_sync_fails(tmp_path, monkeypatch):
+    local_raw = tmp_path / 'raw'
+    local_raw.mkdir()
+
+    async def failing(cmd, on_path=None):
+        raise OSError("Sync returned code: 30")
+    monkeypatch.setattr(pipeline, '_run_rsync', failing)
+
+    with pytest.raises(OSError):
+        pipeline.run_pipeline('host', '/home/root/xochitl', str(local_raw), str(tmp_path / 'nice'))
+    assert os.listdir(local_raw) == []
@@ -0,0 +1,89 @@
+import os
+import shutil
+
+from benchmarks.synthetic import write_document
+from reScriptable.sync import retention
+
+
+def make_snapshot(local_raw, name, previous=None):
+    """
+    Make a snapshot like sync does with rsync --link-dest: files of the previous snapshot are hard linked.
+    """
+    path = os.path.join(local_raw, name)
+    if previous is None:
+        os.makedirs(os.path.join(path, 'xochitl'))
+        write_document(os.path.join(path, 'xochitl'), 'a', n_strokes=5)
+    else:
+        shutil.copytree(os.path.join(local_raw, previous), path, copy_function=os.link)
+    return path
+
+
+def point_latest(local_raw, path):
+    latest = os.path.join(local_raw, 'latest')
+    if os.path.lexists(latest):
+        os.remove(latest)
+    os.symlink(path, latest)
+
+
+def test_prune_keeps_the_latest_snapshot(tmp_path):
+    local_raw = str(tmp_path)
+    old = make_snapshot(local_raw, '2024-01-01 10:00:00')
+    new = make_snapshot(local_raw, '2024-01-01 11:00:00', '2024-01-01 10:00:00')
+    point_latest(local_raw, old)
+
+    report = retention.prune(local_raw, hourly=1, daily=0, weekly=0, monthly=0)
+    assert report['kept'] == sorted([old, new])
+    assert report['removed'] == []
+    assert os.path.isdir(old)
+
+
+def test_prune_reports_only_inodes_freed_by_all_removed_links(tmp_path):
+    local_raw = str(tmp_path)
+    first = make_snapshot(local_raw, '2024-01-01 10:00:00')
+    second = make_snapshot(local_raw, '2024-01-01 11:00:00', '2024-01-01 10:00:00')
+    third = make_snapshot(local_raw, '2024-01-01 12:00:00', '2024-01-01 11:00:00')
+    point_latest(local_raw, third)
+
+    # A file only in the removed snapshots, and one that was replaced in the kept one
+    with open(os.path.join(first, 'xochitl', 'only_old'), 'w') as f:
+        f.write('x' * 10)
+    with open(os.path.join(second, 'xochitl', 'only_old'), 'w') as f:
+        f.write('y' * 20)
+    content = os.path.join(third, 'xochitl', 'a.content')
+    os.remove(content)
+    with open(content, 'w') as f:
+        f.write('{}')
+    old_content_size = os.path.getsize(os.path.join(first, 'xochitl', 'a.content'))
+
+    report = retention.prune(local_raw, hourly=1, daily=0, weekly=0, monthly=0, dry_run=True)
+    assert report['removed'] == [second, first]
+    # Both snapshot directories and their xochitl and a/ directories, two only_old files
+    # and the old a.content, which all links of are removed
+    assert report['inodes'] == 2 * 3 + 2 + 1
+    assert report['bytes'] == 10 + 20 + old_content_size
+    assert os.path.isdir(first)
+
+    retention.prune(local_raw, hourly=1, daily=0, weekly=0, monthly=0)
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert os.path.exists(os.path.join(third, 'xochitl', 'a.content'))
+
+
+def test_compact_links_identical_copies(tmp_path):
+    local_raw = str(tmp_path)
+    first = make_snapshot(local_raw, '2024-01-01 10:00:00')
+    second = os.path.join(local_raw, '2024-01-01 11:00:00')
+    # A copy without hard links, as made without --link-dest
+    shutil.copytree(first, second, copy_function=shutil.copy2)
+    changed = os.path.join(second, 'xochitl', 'a.pagedata')
+    with open(changed, 'a') as f:
+        f.write('Blank\n')
+    n_files = sum(len(files) for _, _, files in os.walk(first))
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(second)
+               for name in files if os.path.join(root, name) != changed)
+
+    report = retention.compact(local_raw)
+    assert report == {'linked': n_files - 1, 'inodes': n_files - 1, 'bytes': size}
+    assert os.path.samefile(os.path.join(first, 'xochitl', 'a.content'), os.path.join(second, 'xochitl', 'a.content'))
+    assert not os.path.samefile(os.path.join(first, 'xochitl', 'a.pagedata'), changed)
+
+    assert retention.compact(local_raw)['linked'] == 0